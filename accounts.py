@@ -0,0 +1,162 @@
+#!/usr/bin/env pipenv-shebang
+import argparse
+import datetime as dt
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import razator_utils
+from dotenv import load_dotenv
+
+from metrics import write_text_atomic
+from model import init_db
+
+ACCOUNT_DEFAULTS = {'tokenstore': None, 'email': None, 'password_env': None, 'workers': 1, 'rate_limit': None}
+
+
+def load_accounts(path):
+    """
+    Read the accounts config, a json list of accounts like
+    {"name": "sam", "tokenstore": "~/.garminconnect-sam", "email": "sam@example.com",
+     "password_env": "SAM_GARMIN_PASSWORD", "workers": 2, "rate_limit": 2}.
+    Only name is required, the password is read from the environment variable named by password_env.
+
+    :param path: Accounts config file (str or pathlib.Path)
+
+    :return: accounts: Settings for each account (list of dicts)
+    """
+    accounts = json.loads(Path(path).expanduser().read_text())
+    names = [account['name'] for account in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Account names must be unique, got {", ".join(names)}')
+    return [{**ACCOUNT_DEFAULTS, 'tokenstore': f'~/.garminconnect-{account["name"]}', **account}
+            for account in accounts]
+
+
+def sync_account(account, start_date, end_date, options):
+    """
+    Sync one account in its own process with its own token store, database pool, response
+    cache and rate limit. Errors are caught so they are reported with the other accounts.
+
+    :param account: Settings for the account (dict)
+    :param start_date: Start date for stats (datetime.date)
+    :param end_date: End date for stats (datetime.date)
+    :param options: Settings shared by every account: chunk_days, incremental, max_retries (dict)
+
+    :return: result: Timing, row counts and any error for the account (dict)
+    """
+    # only the worker processes need the garmin side so the parent doesn't import it
+    from garmin_client import GarminClient
+    from get_stats import login_garmin, sync_range
+    from metrics import RUN_METRICS, InstrumentedGarmin
+    from response_cache import CachedGarmin, ResponseCache
+
+    def api_calls():
+        return sum(counter['value'] for counter in RUN_METRICS.summary()['counters'] if counter['name'] == 'api_calls')
+
+    logger = razator_utils.log.get_stout_logger(f'garmin_{account["name"]}', 'INFO')
+    # a process can sync more than one account so only count the calls made for this one
+    calls_before = api_calls()
+    started = time.perf_counter()
+    result = {'account': account['name'], 'status': 'ok', 'rows': {}, 'error': None}
+    session = None
+    try:
+        password = os.getenv(account['password_env']) if account['password_env'] else None
+        api = GarminClient(InstrumentedGarmin(login_garmin(account['tokenstore'], account['email'], password)),
+                           max_retries=options['max_retries'], max_concurrency=account['workers'],
+                           rate_limit=account['rate_limit'], logger=logger)
+        cache_dir = Path(os.getenv('GARMIN_CACHE_DIR', '~/.cache/garmin_export')).expanduser() / account['name']
+        api = CachedGarmin(api, ResponseCache(cache_dir, logger=logger))
+        session = init_db()
+        counts = sync_range(api, session, start_date, end_date, logger, account['workers'],
+                            chunk_days=options['chunk_days'], incremental=options['incremental'],
+                            account=account['name'])
+        result['rows'] = {table_name: inserted + updated for table_name, (inserted, updated) in counts.items()}
+    except Exception as e:
+        logger.exception(f'Sync of {account["name"]} failed')
+        result.update(status='error', error=f'{type(e).__name__}: {e}')
+    finally:
+        if session is not None:
+            session.close()
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    result['api_calls'] = api_calls() - calls_before
+    return result
+
+
+def sync_accounts(accounts, start_date, end_date, options, processes=None):
+    """
+    Sync every account at the same time in a process pool so a slow or broken account
+    doesn't hold up the others
+
+    :param accounts: Settings for each account (list of dicts)
+    :param start_date: Start date for stats (datetime.date)
+    :param end_date: End date for stats (datetime.date)
+    :param options: Settings shared by every account, see sync_account (dict)
+    :param processes: Most accounts to sync at once, all of them if not given (int)
+
+    :return: report: Results for each account plus totals (dict)
+    """
+    started = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=processes or len(accounts)) as executor:
+        futures = {executor.submit(sync_account, account, start_date, end_date, options): account['name']
+                   for account in accounts}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                # the worker process died, sync_account catches everything else
+                results.append({'account': futures[future], 'status': 'error', 'rows': {},
+                                'error': f'{type(e).__name__}: {e}', 'seconds': None, 'api_calls': None})
+    results.sort(key=lambda result: result['account'])
+    return {'start_date': start_date.isoformat(), 'end_date': end_date.isoformat(),
+            'seconds': round(time.perf_counter() - started, 3),
+            'failed': [result['account'] for result in results if result['status'] != 'ok'],
+            'accounts': results}
+
+
+def print_report(report):
+    print(f'{"account":<16} {"status":<7} {"seconds":>9} {"api calls":>10} {"rows":>9}')
+    for result in report['accounts']:
+        seconds = '-' if result['seconds'] is None else f'{result["seconds"]:.1f}'
+        api_calls = '-' if result['api_calls'] is None else f'{result["api_calls"]:,}'
+        print(f'{result["account"]:<16} {result["status"]:<7} {seconds:>9} {api_calls:>10} '
+              f'{sum(result["rows"].values()):>9,}')
+        if result['error']:
+            print(f'    {result["error"]}')
+    print(f'{len(report["accounts"]) - len(report["failed"])} of {len(report["accounts"])} accounts synced '
+          f'in {report["seconds"]:.1f}s')
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    arg_parser = argparse.ArgumentParser(prog='garmin_accounts', description='Sync several garmin accounts at once')
+    arg_parser.add_argument('-f', '--from_date', default=dt.date.today() - dt.timedelta(days=1),
+                            type=dt.date.fromisoformat, help='Start date for the stats (default yesterday)')
+    arg_parser.add_argument('-e', '--end_date', default=dt.date.today(), type=dt.date.fromisoformat,
+                            help='End date for the stats (default today)')
+    arg_parser.add_argument('-c', '--config', default=os.getenv('GARMIN_ACCOUNTS_FILE', '~/.garmin_accounts.json'),
+                            help='Accounts config (default GARMIN_ACCOUNTS_FILE or ~/.garmin_accounts.json)')
+    arg_parser.add_argument('-p', '--processes', default=None, type=int,
+                            help='Most accounts to sync at once (default all of them)')
+    arg_parser.add_argument('-i', '--incremental', action='store_true',
+                            help='Start each account from its last completed day')
+    arg_parser.add_argument('-d', '--chunk_days', default=30, type=int, help='Days to commit at a time')
+    arg_parser.add_argument('--max_retries', default=5, type=int,
+                            help='Times to retry a failed or throttled garmin call (default 5)')
+    arg_parser.add_argument('-m', '--metrics_dir', default=os.getenv('GARMIN_METRICS_DIR', Path.home() / 'logs'),
+                            type=lambda value: Path(value).expanduser(),
+                            help='Folder for the report json (default GARMIN_METRICS_DIR or ~/logs)')
+    args = arg_parser.parse_args()
+
+    # migrate once up front instead of in every process at the same time
+    init_db().close()
+    accounts_report = sync_accounts(load_accounts(args.config), args.from_date, args.end_date,
+                                    {'chunk_days': args.chunk_days, 'incremental': args.incremental,
+                                     'max_retries': args.max_retries}, args.processes)
+    write_text_atomic(args.metrics_dir / 'garmin_accounts_report.json', json.dumps(accounts_report, indent=2))
+    print_report(accounts_report)
+    if accounts_report['failed'] and (alert_url := os.getenv('DISCORD_ALERT_URL')):
+        razator_utils.discord_message(alert_url, f'Garmin sync failed for {", ".join(accounts_report["failed"])}')
@@ -0,0 +1,286 @@
+import datetime as dt
+import hashlib
+import io
+import mmap
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+
+import razator_utils
+from sqlalchemy import insert
+
+from metrics import RUN_METRICS, timed
+from model import DEFAULT_ACCOUNT, Activity, ActivityLap, ActivityRecord
+from parallel import ordered_map
+from upsert import chunked
+
+SEMICIRCLES_TO_DEGREES = 180 / 2 ** 31
+LAP_FIELDS = {
+    'start_time': 'start_time', 'total_elapsed_time': 'total_elapsed_time', 'total_timer_time': 'total_timer_time',
+    'total_distance': 'total_distance', 'avg_speed': ('enhanced_avg_speed', 'avg_speed'),
+    'max_speed': ('enhanced_max_speed', 'max_speed'), 'avg_heart_rate': 'avg_heart_rate',
+    'max_heart_rate': 'max_heart_rate', 'avg_cadence': 'avg_cadence', 'total_calories': 'total_calories',
+    'total_ascent': 'total_ascent', 'total_descent': 'total_descent',
+}
+RECORD_FIELDS = {
+    'timestamp': 'timestamp', 'latitude': 'position_lat', 'longitude': 'position_long', 'distance': 'distance',
+    'speed': ('enhanced_speed', 'speed'), 'altitude': ('enhanced_altitude', 'altitude'),
+    'heart_rate': 'heart_rate', 'cadence': 'cadence',
+}
+
+
+class FitStore:
+    """
+    Content addressed store of the original FIT files. Each file is saved once under the
+    sha256 of its content in objects/ and activities/<activity_id> holds the hash of its file.
+    Downloads that failed are noted in failed/<activity_id> so they aren't tried on every sync,
+    delete the note to try again.
+    """
+
+    def __init__(self, root=None):
+        """
+        :param root: Folder for the store, defaults to ~/.local/share/garmin_export/fit (str or pathlib.Path)
+        """
+        self.root = Path(root).expanduser() if root else Path.home() / '.local' / 'share' / 'garmin_export' / 'fit'
+        self._activities_dir = self.root / 'activities'
+        self._objects_dir = self.root / 'objects'
+        self._failed_dir = self.root / 'failed'
+
+    def _object_path(self, content_hash):
+        return self._objects_dir / content_hash[:2] / f'{content_hash}.fit'
+
+    def has(self, activity_id):
+        return (self._activities_dir / str(activity_id)).exists()
+
+    def has_failed(self, activity_id):
+        return (self._failed_dir / str(activity_id)).exists()
+
+    def mark_failed(self, activity_id, error):
+        """
+        :param activity_id: Activity whose download failed (int)
+        :param error: What went wrong (str)
+        """
+        self._failed_dir.mkdir(parents=True, exist_ok=True)
+        (self._failed_dir / str(activity_id)).write_text(error)
+
+    def path(self, activity_id):
+        """
+        :param activity_id: Activity to find (int)
+
+        :return: path: The activity's FIT file, None if it hasn't been downloaded (pathlib.Path)
+        """
+        try:
+            content_hash = (self._activities_dir / str(activity_id)).read_text().strip()
+        except FileNotFoundError:
+            return None
+        return self._object_path(content_hash)
+
+    def activity_ids(self):
+        """
+        :return: Every activity with a stored FIT file (list of int)
+        """
+        return sorted(int(path.name) for path in self._activities_dir.glob('*') if path.name.isdigit())
+
+    def put(self, activity_id, archive):
+        """
+        Save the FIT file out of the zip garmin sends for an original download, streaming it to
+        disk while it is hashed
+
+        :param activity_id: Activity the file is for (int)
+        :param archive: Zip from api.download_activity (bytes)
+
+        :return: path: Where the FIT file was saved (pathlib.Path)
+        """
+        self._objects_dir.mkdir(parents=True, exist_ok=True)
+        self._activities_dir.mkdir(parents=True, exist_ok=True)
+        with zipfile.ZipFile(io.BytesIO(archive)) as zipped:
+            member = next(name for name in zipped.namelist() if name.lower().endswith('.fit'))
+            hasher = hashlib.sha256()
+            fd, tmp_path = tempfile.mkstemp(dir=self._objects_dir, suffix='.tmp')
+            with zipped.open(member) as source, os.fdopen(fd, 'wb') as target:
+                while block := source.read(1024 * 1024):
+                    hasher.update(block)
+                    target.write(block)
+        object_path = self._object_path(hasher.hexdigest())
+        object_path.parent.mkdir(exist_ok=True)
+        if object_path.exists():
+            os.unlink(tmp_path)
+        else:
+            os.replace(tmp_path, object_path)
+        (self._activities_dir / str(activity_id)).write_text(hasher.hexdigest())
+        (self._failed_dir / str(activity_id)).unlink(missing_ok=True)
+        return object_path
+
+
+def _message_row(message, fields):
+    values = message.get_values()
+    row = {}
+    for column, source in fields.items():
+        sources = source if isinstance(source, tuple) else (source,)
+        row[column] = next((values[name] for name in sources if values.get(name) is not None), None)
+        if isinstance(row[column], dt.datetime):
+            row[column] = row[column].replace(tzinfo=dt.timezone.utc)
+    return row
+
+
+@timed('parse_fit')
+def parse_fit_file(activity_id, path):
+    """
+    Read the laps and records out of a FIT file, memory mapping it instead of reading it in
+
+    :param activity_id: Activity the file is for (int)
+    :param path: FIT file (pathlib.Path)
+
+    :return: laps, records: Rows for activity_laps and activity_records (list of dicts, list of dicts)
+    """
+    # only syncs with details need fitparse so it isn't imported with the module
+    import fitparse
+
+    laps, records = [], []
+    with open(path, 'rb') as fit_file, mmap.mmap(fit_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for message in fitparse.FitFile(mapped).get_messages(['lap', 'record']):
+            if message.name == 'lap':
+                laps.append({'activity_id': activity_id, 'lap_index': len(laps), **_message_row(message, LAP_FIELDS)})
+                continue
+            record = _message_row(message, RECORD_FIELDS)
+            if record['timestamp'] is None:
+                continue
+            for column in ('latitude', 'longitude'):
+                if record[column] is not None:
+                    record[column] *= SEMICIRCLES_TO_DEGREES
+            records.append({'activity_id': activity_id, **record})
+    # a paused watch can write two records for the same second
+    records = list({record['timestamp']: record for record in records}.values())
+    return laps, records
+
+
+def save_details(session, activity_ids, laps, records, chunk_size=5000):
+    """
+    Replace the laps and records for activities with bulk inserts
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param activity_ids: Activities being replaced (list of int)
+    :param laps: Rows for activity_laps (list of dicts)
+    :param records: Rows for activity_records (list of dicts)
+    :param chunk_size: Max rows in each insert (int)
+    """
+    for model, rows in ((ActivityLap, laps), (ActivityRecord, records)):
+        session.execute(model.__table__.delete().where(model.activity_id.in_(activity_ids)))
+        for chunk in chunked(rows, chunk_size):
+            with RUN_METRICS.timer('db_write', table=model.__tablename__):
+                session.execute(insert(model.__table__), chunk)
+            RUN_METRICS.increment('rows_written', len(chunk), table=model.__tablename__, action='inserted')
+
+
+def parse_into_db(session, store, activity_ids, batch_size=50,
+                  logger=razator_utils.log.get_stout_logger('garmin_details')):
+    """
+    Parse stored FIT files into activity_laps and activity_records, committing a batch of
+    activities at a time
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param store: Where the FIT files are (FitStore)
+    :param activity_ids: Activities to parse, ones without a stored file are skipped (list of int)
+    :param batch_size: Activities to commit at a time (int)
+    :param logger: Logger object (logging.Logger)
+
+    :return: parsed: Number of activities parsed (int)
+    """
+    parsed = 0
+    for batch in chunked([activity_id for activity_id in activity_ids if store.has(activity_id)], batch_size):
+        parsed_ids, laps, records = [], [], []
+        for activity_id in batch:
+            try:
+                activity_laps, activity_records = parse_fit_file(activity_id, store.path(activity_id))
+            except Exception:
+                logger.exception(f'Could not parse the FIT file for activity {activity_id}')
+                continue
+            parsed_ids.append(activity_id)
+            laps += activity_laps
+            records += activity_records
+        # activities that failed to parse keep whatever rows they had
+        save_details(session, parsed_ids, laps, records)
+        session.commit()
+        parsed += len(parsed_ids)
+        logger.info(f'Parsed {parsed} activities ({len(records)} records in the last batch)')
+    return parsed
+
+
+def download_fit_files(api, store, activity_ids, workers=4,
+                       logger=razator_utils.log.get_stout_logger('garmin_details')):
+    """
+    Download the original FIT files for activities that aren't in the store yet
+
+    :param api: garmin API Class (Garmin)
+    :param store: Where to save the FIT files (FitStore)
+    :param activity_ids: Activities to download (list of int)
+    :param workers: Number of downloads to run at the same time (int)
+    :param logger: Logger object (logging.Logger)
+
+    :return: downloaded: Activities that were downloaded (list of int)
+    """
+    from garminconnect import Garmin
+
+    def download(activity_id):
+        try:
+            archive = api.download_activity(activity_id, dl_fmt=Garmin.ActivityDownloadFormat.ORIGINAL)
+            store.put(activity_id, archive)
+        except Exception as e:
+            logger.exception(f'Could not download the FIT file for activity {activity_id}')
+            store.mark_failed(activity_id, f'{type(e).__name__}: {e}')
+            return None
+        return activity_id
+
+    missing = [activity_id for activity_id in activity_ids if not store.has(activity_id)]
+    downloaded = [activity_id for activity_id in ordered_map(download, missing, workers) if activity_id is not None]
+    logger.info(f'Downloaded {len(downloaded)} of {len(missing)} missing FIT files')
+    return downloaded
+
+
+def activities_without_fit_files(session, store, account=DEFAULT_ACCOUNT):
+    """
+    Find the activities that haven't been downloaded yet. Activities whose FIT file has no
+    laps or didn't parse are left alone since downloading them again wouldn't change that.
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param store: Where the FIT files are (FitStore)
+    :param account: Account the activities belong to (str)
+
+    :return: Activities that should have a FIT file and aren't in the store or failed before (list of int)
+    """
+    return [row[0] for row in session.query(Activity.activity_id)
+            .filter(Activity.account == account, Activity.manual_activity.is_(False))
+            .order_by(Activity.start_time_local)
+            if not store.has(row[0]) and not store.has_failed(row[0])]
+
+
+def sync_activity_details(session, api, store, workers=4,
+                          logger=razator_utils.log.get_stout_logger('garmin_details'), account=DEFAULT_ACCOUNT):
+    """
+    Download and parse the FIT files for every activity that hasn't been downloaded yet
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param api: garmin API Class (Garmin)
+    :param store: Where to save the FIT files (FitStore)
+    :param workers: Number of downloads to run at the same time (int)
+    :param logger: Logger object (logging.Logger)
+    :param account: Account the api is logged in to (str)
+
+    :return: parsed: Number of activities parsed (int)
+    """
+    activity_ids = activities_without_fit_files(session, store, account)
+    return parse_into_db(session, store, download_fit_files(api, store, activity_ids, workers, logger), logger=logger)
+
+
+def reparse_store(session, store, logger=razator_utils.log.get_stout_logger('garmin_details')):
+    """
+    Parse every FIT file in the store again without calling garmin
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param store: Where the FIT files are (FitStore)
+    :param logger: Logger object (logging.Logger)
+
+    :return: parsed: Number of activities parsed (int)
+    """
+    return parse_into_db(session, store, store.activity_ids(), logger=logger)
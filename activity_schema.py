@@ -0,0 +1,85 @@
+import datetime as dt
+
+import razator_utils
+
+from model import Activity
+
+ACTIVITY_FIELDS = [
+    'activityId', 'activityName', 'startTimeLocal', 'startTimeGMT',
+    'distance', 'duration',
+    'movingDuration', 'elevationGain', 'elevationLoss', 'averageSpeed',
+    'maxSpeed', 'calories',
+    'averageHR', 'maxHR',
+    'steps', 'timeZoneId',
+    'beginTimestamp', 'vO2MaxValue', 'workoutId', 'deviceId',
+    'minElevation', 'maxElevation', 'locationName', 'lapCount',
+    'caloriesConsumed',
+    'minActivityLapDuration', 'hasSplits',
+    'moderateIntensityMinutes', 'vigorousIntensityMinutes',
+    'pr', 'manualActivity', 'autoCalcCalories', 'elevationCorrected']
+NESTED_FIELDS = {'activityType': 'activity_type', 'eventType': 'event_type'}
+FIELD_CONVERSIONS = {'startTimeLocal': dt.datetime.fromisoformat, 'startTimeGMT': dt.datetime.fromisoformat}
+
+
+def _snake_to_camel(name):
+    first, *rest = name.split('_')
+    return first + ''.join(part.title() for part in rest)
+
+
+class ActivityFlattener:
+    """
+    Turns raw garmin activities into rows for a model. The path to each column in the raw
+    activity, its name and any type conversion are worked out once when the flattener is
+    built instead of for every activity.
+    """
+
+    def __init__(self, model=Activity):
+        """
+        :param model: Model the rows are for (Activity)
+        """
+        columns = model.__table__.columns.keys()
+        self.top_level = []
+        self.nested = []
+        for field in ACTIVITY_FIELDS:
+            column = razator_utils.camel_to_snake(field)
+            if column in columns:
+                self.top_level.append((column, field, FIELD_CONVERSIONS.get(field)))
+        for field, prefix in NESTED_FIELDS.items():
+            children = tuple((column, _snake_to_camel(column[len(prefix) + 1:]))
+                             for column in columns if column.startswith(f'{prefix}_'))
+            self.nested.append((field, children))
+        self.columns = [column for column, _, _ in self.top_level] + \
+                       [column for _, children in self.nested for column, _ in children]
+
+    def flatten(self, activity):
+        """
+        Flatten one raw activity
+
+        :param activity: Activity from api.get_activities_by_date (dict)
+
+        :return: flat_act: Row for the model, missing values are None (dict)
+        """
+        get = activity.get
+        flat_act = {}
+        for column, field, convert in self.top_level:
+            value = get(field)
+            flat_act[column] = convert(value) if convert and value is not None else value
+        for field, children in self.nested:
+            nested_get = (get(field) or {}).get
+            for column, child in children:
+                flat_act[column] = nested_get(child)
+        return flat_act
+
+    def flatten_all(self, activities):
+        """
+        Flatten a batch of raw activities
+
+        :param activities: Activities from api.get_activities_by_date (list of dicts)
+
+        :return: flat_activities: Rows for the model (list of dicts)
+        """
+        flatten = self.flatten
+        return [flatten(activity) for activity in activities]
+
+
+ACTIVITY_FLATTENER = ActivityFlattener()
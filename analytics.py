@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy import func, select
+
+from model import DEFAULT_ACCOUNT, GarminStat, WeighIn
+
+YEAR_STEP_GOAL = 5000000
+WEIGHT_TREND_ALPHA = 0.1
+# decay ** -EWMA_BLOCK has to stay well inside float64 for any alpha we'd use
+EWMA_BLOCK = 256
+
+_loaded = {}
+
+
+class GarminArrays:
+    """
+    daily_stats and weigh_ins for one account as contiguous NumPy arrays sorted by date
+    """
+
+    def __init__(self, dates, steps, step_goals, weigh_dates, weights):
+        """
+        :param dates: Days with daily stats (numpy datetime64[D] array)
+        :param steps: Total steps for each day (numpy int64 array)
+        :param step_goals: Step goal for each day (numpy int64 array)
+        :param weigh_dates: Days with a weigh-in (numpy datetime64[D] array)
+        :param weights: Average weight in lbs for each weigh-in day (numpy float64 array)
+        """
+        self.dates = dates
+        self.steps = steps
+        self.step_goals = step_goals
+        self.weigh_dates = weigh_dates
+        self.weights = weights
+
+    @property
+    def goal_met(self):
+        return (self.steps >= self.step_goals) & (self.step_goals != 0)
+
+    def save(self, path, fingerprint):
+        np.savez(path, dates=self.dates, steps=self.steps, step_goals=self.step_goals,
+                 weigh_dates=self.weigh_dates, weights=self.weights, fingerprint=np.array(json.dumps(fingerprint)))
+
+
+def _fingerprint(session, account):
+    # row counts catch new rows and updated_at catches rows that were synced again
+    fingerprint = {}
+    for model in (GarminStat, WeighIn):
+        count, changed = session.execute(select(func.count(), func.max(model.updated_at))
+                                         .where(model.account == account)).one()
+        fingerprint[model.__tablename__] = [count, str(changed)]
+    return fingerprint
+
+
+def _query_arrays(session, account):
+    stats = session.execute(select(GarminStat.date, GarminStat.total_steps, GarminStat.step_goal)
+                            .where(GarminStat.account == account).order_by(GarminStat.date)).all()
+    dates, steps, step_goals = zip(*stats) if stats else ((), (), ())
+    weigh_ins = session.execute(select(WeighIn.calendar_date, WeighIn.weight_lbs)
+                                .where(WeighIn.account == account)).all()
+    weigh_in_dates, weigh_in_weights = zip(*weigh_ins) if weigh_ins else ((), ())
+
+    # average the weigh-ins of each day, np.unique also sorts the days
+    weigh_dates, day_index = np.unique(np.array(weigh_in_dates, dtype='datetime64[D]'), return_inverse=True)
+    weight_sums = np.bincount(day_index, weights=np.array(weigh_in_weights, dtype=np.float64),
+                              minlength=len(weigh_dates))
+    weights = weight_sums / np.maximum(np.bincount(day_index, minlength=len(weigh_dates)), 1)
+    return GarminArrays(np.array(dates, dtype='datetime64[D]'), np.array(steps, dtype=np.int64),
+                        np.array(step_goals, dtype=np.int64), weigh_dates, weights)
+
+
+def load_arrays(session, account=DEFAULT_ACCOUNT, cache_dir=None):
+    """
+    Load an account's daily stats and weigh-ins as arrays. They are kept in memory and saved
+    to cache_dir, and only queried again when the tables' row counts or last updated_at change.
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param account: Account to load (str)
+    :param cache_dir: Folder for the saved arrays, defaults to analytics in GARMIN_CACHE_DIR (str or pathlib.Path)
+
+    :return: arrays: The account's data (GarminArrays)
+    """
+    cache_dir = Path(cache_dir or Path(os.getenv('GARMIN_CACHE_DIR', '~/.cache/garmin_export')) / 'analytics')
+    database = session.get_bind().url.render_as_string(hide_password=True)
+    key = hashlib.sha256(f'{database}|{account}'.encode()).hexdigest()[:16]
+    fingerprint = _fingerprint(session, account)
+
+    cache_path = cache_dir.expanduser() / f'{key}.npz'
+    if cache_path in _loaded and _loaded[cache_path][0] == fingerprint:
+        return _loaded[cache_path][1]
+    arrays = None
+    if cache_path.exists():
+        with np.load(cache_path) as saved:
+            if json.loads(str(saved['fingerprint'])) == fingerprint:
+                arrays = GarminArrays(saved['dates'], saved['steps'], saved['step_goals'],
+                                      saved['weigh_dates'], saved['weights'])
+    if arrays is None:
+        arrays = _query_arrays(session, account)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        arrays.save(cache_path, fingerprint)
+    _loaded[cache_path] = (fingerprint, arrays)
+    return arrays
+
+
+def _day(value):
+    return np.datetime64(value, 'D')
+
+
+def goal_streaks(arrays, end_date=None):
+    """
+    Find the runs of consecutive days that met the step goal. A day without stats ends a run.
+
+    :param arrays: Data to look at (GarminArrays)
+    :param end_date: Last day to look at, defaults to the last day with stats (datetime.date)
+
+    :return: streaks: Current and longest streak lengths and the last day of the longest (dict)
+    """
+    end = np.searchsorted(arrays.dates, _day(end_date), side='right') if end_date else len(arrays.dates)
+    dates, met = arrays.dates[:end], arrays.goal_met[:end]
+    if not met.any():
+        return {'current': 0, 'longest': 0, 'longest_end': None}
+    follows = np.concatenate([[False], (np.diff(dates) == np.timedelta64(1, 'D')) & met[:-1]])
+    run_ids = np.cumsum(met & ~follows)
+    lengths = np.bincount(run_ids[met])
+    longest_run = int(lengths.argmax())
+    return {'current': int(lengths[run_ids[-1]]) if met[-1] else 0, 'longest': int(lengths[longest_run]),
+            'longest_end': dates[np.flatnonzero(met & (run_ids == longest_run))[-1]].item()}
+
+
+def rolling_mean(dates, values, window):
+    """
+    Average values over a trailing window of calendar days, days without a value are left out
+
+    :param dates: Days the values are for, sorted (numpy datetime64[D] array)
+    :param values: Value for each day (numpy array)
+    :param window: Days in the window (int)
+
+    :return: days, means: Every day from the first to the last date and the window's average ending
+        on it, NaN when the window has no values (numpy datetime64[D] array, numpy float64 array)
+    """
+    if not len(dates):
+        return dates, np.array([], dtype=np.float64)
+    offsets = (dates - dates[0]).astype(np.int64)
+    days = dates[0] + np.arange(offsets[-1] + 1)
+    totals = np.zeros(len(days) + 1)
+    counts = np.zeros(len(days) + 1)
+    np.add.at(totals, offsets + 1, values)
+    np.add.at(counts, offsets + 1, 1)
+    totals, counts = np.cumsum(totals), np.cumsum(counts)
+    starts = np.maximum(np.arange(1, len(days) + 1) - window, 0)
+    window_counts = counts[1:] - counts[starts]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(window_counts > 0, (totals[1:] - totals[starts]) / window_counts, np.nan)
+    return days, means
+
+
+def ewma(values, alpha=WEIGHT_TREND_ALPHA):
+    """
+    Exponentially weighted moving average, worked out a block at a time with cumulative sums
+    instead of a python loop over every value
+
+    :param values: Values in order (numpy float64 array)
+    :param alpha: Weight of each new value (float)
+
+    :return: Smoothed values (numpy float64 array)
+    """
+    smoothed = np.empty(len(values))
+    decay = 1 - alpha
+    previous = values[0] if len(values) else 0.0
+    for start in range(0, len(values), EWMA_BLOCK):
+        block = values[start:start + EWMA_BLOCK]
+        powers = decay ** np.arange(1, len(block) + 1)
+        smoothed[start:start + len(block)] = powers * previous + alpha * powers * np.cumsum(block / powers)
+        previous = smoothed[start + len(block) - 1]
+    return smoothed
+
+
+def weight_trend(arrays, alpha=WEIGHT_TREND_ALPHA):
+    """
+    :param arrays: Data to smooth (GarminArrays)
+    :param alpha: Weight of each new weigh-in day (float)
+
+    :return: days, trend: Weigh-in days and the smoothed weight on each (numpy datetime64[D] array, numpy array)
+    """
+    return arrays.weigh_dates, ewma(arrays.weights, alpha)
+
+
+def daily_weights(arrays, start_date, end_date):
+    """
+    :param arrays: Data to look at (GarminArrays)
+    :param start_date: First day to get (datetime.date)
+    :param end_date: Last day to get (datetime.date)
+
+    :return: Average weight in lbs keyed by date (dict)
+    """
+    start = np.searchsorted(arrays.weigh_dates, _day(start_date))
+    end = np.searchsorted(arrays.weigh_dates, _day(end_date), side='right')
+    return dict(zip(arrays.weigh_dates[start:end].tolist(), np.round(arrays.weights[start:end], 1).tolist()))
+
+
+def year_pace(totals, year_goal=YEAR_STEP_GOAL):
+    """
+    :param totals: Step totals from step_summary.get_step_totals (dict)
+    :param year_goal: Steps to reach in the year (int)
+
+    :return: pace: Steps the goal expects by now, how far ahead of that the year is, and the steps
+        still needed overall and per remaining day (dict)
+    """
+    ytd_days, _, ytd_steps = totals['ytd']
+    goal_pace = year_goal / 365 * ytd_days
+    remaining_days = 365 - ytd_days
+    return {'goal_pace': goal_pace, 'difference': ytd_steps - goal_pace, 'remaining': year_goal - ytd_steps,
+            'per_day': int((year_goal - ytd_steps) / remaining_days) if remaining_days > 0 else None}
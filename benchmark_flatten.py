@@ -0,0 +1,80 @@
+#!/usr/bin/env pipenv-shebang
+import argparse
+import datetime as dt
+import random
+import time
+
+import razator_utils
+
+from activity_schema import ActivityFlattener
+from fake_garmin import synthetic_activity
+
+
+def synthetic_activities(count, seed=0):
+    """
+    Make raw activities shaped like the ones from api.get_activities_by_date
+
+    :param count: Number of activities to make (int)
+    :param seed: Seed for the random values (int)
+
+    :return: activities: Raw activities (list of dicts)
+    """
+    rand = random.Random(seed)
+    start = dt.datetime(2013, 9, 1, 6)
+    return [synthetic_activity(1000000000 + i, start + dt.timedelta(hours=i * 3), rand) for i in range(count)]
+
+
+def legacy_flatten(acts):
+    """
+    The per-record transform get_garmin_activities used before the compiled flattener
+    """
+    keep_cols = [
+        'activityId', 'activityName', 'startTimeLocal', 'startTimeGMT',
+        'activityType', 'eventType', 'distance', 'duration',
+        'movingDuration', 'elevationGain', 'elevationLoss', 'averageSpeed',
+        'maxSpeed', 'calories',
+        'averageHR', 'maxHR',
+        'steps', 'timeZoneId',
+        'beginTimestamp', 'vO2MaxValue', 'workoutId', 'deviceId',
+        'minElevation', 'maxElevation', 'locationName', 'lapCount',
+        'caloriesConsumed',
+        'minActivityLapDuration', 'hasSplits',
+        'moderateIntensityMinutes', 'vigorousIntensityMinutes',
+        'pr', 'manualActivity', 'autoCalcCalories', 'elevationCorrected']
+    time_columns = ['startTimeLocal', 'startTimeGMT']
+    flat_activities = []
+    while acts:
+        flat_act = razator_utils.flatten_dict({k: v for k, v in acts.pop(0).items() if k in keep_cols})
+        rename_columns = {col: razator_utils.camel_to_snake(col) for col in flat_act.keys()}
+        for col in time_columns:
+            flat_act[col] = dt.datetime.fromisoformat(flat_act[col])
+        flat_act = {rename_columns.get(k, k): v for k, v in flat_act.items()}
+        if 'activity_type_sort_order' in flat_act.keys():
+            del flat_act['activity_type_sort_order']
+        flat_activities.append(flat_act)
+    return flat_activities
+
+
+def time_it(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(prog='benchmark_flatten',
+                                         description='Compare the compiled activity flattener to the old loop')
+    arg_parser.add_argument('-n', '--count', default=100000, type=int, help='Activities to flatten (default 100000)')
+    args = arg_parser.parse_args()
+
+    flattener, build_time = time_it(ActivityFlattener)
+    compiled_rows, compiled_time = time_it(flattener.flatten_all, synthetic_activities(args.count))
+    legacy_rows, legacy_time = time_it(legacy_flatten, synthetic_activities(args.count))
+
+    mismatches = sum(1 for compiled, legacy in zip(compiled_rows, legacy_rows) if compiled != legacy)
+    print(f'Flattened {args.count:,} activities')
+    print(f'legacy loop:  {legacy_time:8.3f}s ({args.count / legacy_time:,.0f} / sec)')
+    print(f'compiled:     {compiled_time:8.3f}s ({args.count / compiled_time:,.0f} / sec, '
+          f'{build_time * 1000:.2f}ms to build)')
+    print(f'speedup:      {legacy_time / compiled_time:8.1f}x')
+    print(f'rows that differ: {mismatches:,}')
@@ -0,0 +1,99 @@
+#!/usr/bin/env pipenv-shebang
+import argparse
+import datetime as dt
+import json
+import os
+import time
+import tracemalloc
+
+import razator_utils
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from fake_garmin import FakeGarmin
+from garmin_client import GarminClient
+from get_stats import sync_range
+from migrations import migrate, migration_metadata
+from model import Base, create_db_engine
+
+SCENARIOS = {'1_day': 1, '1_year': 365, '8_years': 365 * 8}
+
+
+def run_scenario(engine, days, args, logger):
+    """
+    Sync days worth of made up data into an empty database and measure it
+
+    :param engine: Engine for the benchmark database (sqlalchemy.engine.Engine)
+    :param days: Days of data to sync, ending yesterday (int)
+    :param args: Parsed command line arguments (argparse.Namespace)
+    :param logger: Logger object (logging.Logger)
+
+    :return: results: Measurements for the run (dict)
+    """
+    Base.metadata.drop_all(engine)
+    migration_metadata.drop_all(engine)
+    migrate(engine, Base.metadata)
+    statements = []
+
+    def count_statement(*_):
+        statements.append(1)
+
+    event.listen(engine, 'before_cursor_execute', count_statement)
+
+    fake_api = FakeGarmin(seed=args.seed, latency=args.latency, error_rate=args.error_rate,
+                          throttle_rate=args.throttle_rate, retry_after=0)
+    api = GarminClient(fake_api, base_delay=0.01, max_delay=1, max_concurrency=args.workers, logger=logger)
+    session = sessionmaker(bind=engine)()
+    end_date = dt.date.today() - dt.timedelta(days=1)
+    start_date = end_date - dt.timedelta(days=days - 1)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    counts = sync_range(api, session, start_date, end_date, logger, workers=args.workers,
+                        chunk_days=args.chunk_days, chunk_size=args.chunk_size, intraday=args.intraday)
+    elapsed = time.perf_counter() - started
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    session.close()
+    event.remove(engine, 'before_cursor_execute', count_statement)
+
+    rows = sum(inserted + updated for inserted, updated in counts.values())
+    api_calls = sum(fake_api.calls.values())
+    return {'days': days, 'seconds': round(elapsed, 3), 'rows': rows, 'rows_per_sec': round(rows / elapsed, 1),
+            'api_calls': api_calls, 'api_calls_per_day': round(api_calls / days, 3),
+            'peak_memory_mb': round(peak_memory / 1024 ** 2, 2), 'db_statements': len(statements)}
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    arg_parser = argparse.ArgumentParser(prog='benchmark_ingest',
+                                         description='Benchmark the sync against a fake garmin API')
+    arg_parser.add_argument('-u', '--database_url', default=os.getenv('GARMIN_BENCHMARK_DATABASE_URL'),
+                            help='Database to benchmark against, its tables are dropped '
+                                 '(default GARMIN_BENCHMARK_DATABASE_URL)')
+    arg_parser.add_argument('-s', '--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS),
+                            help='Scenarios to run (default all)')
+    arg_parser.add_argument('-l', '--latency', default=0.0, type=float, help='Seconds each API call takes')
+    arg_parser.add_argument('--error_rate', default=0.0, type=float, help='Chance each API call fails')
+    arg_parser.add_argument('--throttle_rate', default=0.0, type=float, help='Chance each API call is throttled')
+    arg_parser.add_argument('-w', '--workers', default=1, type=int, help='Requests to run at the same time')
+    arg_parser.add_argument('-d', '--chunk_days', default=30, type=int, help='Days to commit at a time')
+    arg_parser.add_argument('-c', '--chunk_size', default=1000, type=int, help='Rows in each statement')
+    arg_parser.add_argument('--intraday', action='store_true', help='Also load the intraday series')
+    arg_parser.add_argument('--seed', default=0, type=int, help='Seed for the fake data')
+    arg_parser.add_argument('-o', '--output', default=None, help='Also save the results to this json file')
+    args = arg_parser.parse_args()
+    if not args.database_url:
+        raise KeyError('Please pass --database_url or set GARMIN_BENCHMARK_DATABASE_URL, '
+                       'it should not be your real database')
+
+    benchmark_logger = razator_utils.log.get_stout_logger('garmin_benchmark', 'WARNING')
+    benchmark_engine = create_db_engine(args.database_url)
+    results = {}
+    for scenario in args.scenarios:
+        results[scenario] = run_scenario(benchmark_engine, SCENARIOS[scenario], args, benchmark_logger)
+        print(f'{scenario:>8}: ' + ', '.join(f'{k} {v:,}' for k, v in results[scenario].items()))
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
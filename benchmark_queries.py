@@ -0,0 +1,118 @@
+#!/usr/bin/env pipenv-shebang
+import argparse
+import datetime as dt
+import json
+import os
+import tempfile
+import time
+
+import razator_utils
+from dotenv import load_dotenv
+from sqlalchemy import func, text
+from sqlalchemy.orm import sessionmaker
+
+from analytics import daily_weights, load_arrays
+from fake_garmin import FakeGarmin
+from get_stats import sync_range
+from migrations import migrate, migration_metadata
+from model import Activity, Base, create_db_engine
+from reclassify import RULES
+from step_summary import step_aggregates
+from weights_to_gsheet import get_daily_distances
+
+
+def cold_daily_weights(session, start_date, end_date):
+    # a new cache folder each run so the arrays are queried instead of coming back from the
+    # cache, and the benchmark database never ends up in the real GARMIN_CACHE_DIR
+    with tempfile.TemporaryDirectory() as cache_dir:
+        return daily_weights(load_arrays(session, cache_dir=cache_dir), start_date, end_date)
+
+
+def benchmark_queries(session, end_date):
+    """
+    The queries the reports run, keyed by name
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param end_date: Last day of data in the database (datetime.date)
+
+    :return: queries: Functions that run each query (dict of callables)
+    """
+    year_start = end_date - dt.timedelta(days=364)
+    return {
+        'daily_distances_year': lambda: get_daily_distances(session, year_start, end_date),
+        'daily_weights_year': lambda: cold_daily_weights(session, year_start, end_date),
+        'activities_one_day': lambda: session.query(func.count()).select_from(Activity)
+        .filter(func.date(Activity.start_time_local) == end_date).scalar(),
+        'reclassify_matches': lambda: session.query(func.count()).select_from(Activity)
+        .filter(*RULES[0].db_filter()).scalar(),
+        'steps_ytd': lambda: step_aggregates(session, dt.date(end_date.year, 1, 1), end_date),
+    }
+
+
+def time_queries(session, end_date, repeats):
+    """
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param end_date: Last day of data in the database (datetime.date)
+    :param repeats: Times to run each query, the fastest run is kept (int)
+
+    :return: timings: Best time in milliseconds keyed by query name (dict)
+    """
+    timings = {}
+    for name, query in benchmark_queries(session, end_date).items():
+        runs = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            query()
+            runs.append(time.perf_counter() - started)
+        timings[name] = round(min(runs) * 1000, 3)
+    return timings
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    arg_parser = argparse.ArgumentParser(prog='benchmark_queries',
+                                         description='Time the report queries before and after the migrations')
+    arg_parser.add_argument('-u', '--database_url', default=os.getenv('GARMIN_BENCHMARK_DATABASE_URL'),
+                            help='Database to benchmark against, its tables are dropped '
+                                 '(default GARMIN_BENCHMARK_DATABASE_URL)')
+    arg_parser.add_argument('-y', '--years', default=8, type=int, help='Years of made up data to load (default 8)')
+    arg_parser.add_argument('-a', '--activities_per_day', default=3.0, type=float,
+                            help='Average activities made up for each day (default 3)')
+    arg_parser.add_argument('-r', '--repeats', default=20, type=int, help='Times to run each query (default 20)')
+    arg_parser.add_argument('--seed', default=0, type=int, help='Seed for the fake data')
+    arg_parser.add_argument('-o', '--output', default=None, help='Also save the results to this json file')
+    args = arg_parser.parse_args()
+    if not args.database_url:
+        raise KeyError('Please pass --database_url or set GARMIN_BENCHMARK_DATABASE_URL, '
+                       'it should not be your real database')
+
+    benchmark_logger = razator_utils.log.get_stout_logger('garmin_benchmark', 'WARNING')
+    engine = create_db_engine(args.database_url)
+    Base.metadata.drop_all(engine)
+    migration_metadata.drop_all(engine)
+    # only create the tables so the first timings are without the indexes the later migrations add
+    migrate(engine, Base.metadata, target=1)
+
+    session = sessionmaker(bind=engine)()
+    end_date = dt.date.today() - dt.timedelta(days=1)
+    start_date = end_date - dt.timedelta(days=365 * args.years - 1)
+    sync_range(FakeGarmin(seed=args.seed, activities_per_day=args.activities_per_day), session, start_date,
+               end_date, benchmark_logger, chunk_days=365)
+    session.execute(text('ANALYZE'))
+    session.commit()
+    results = {'before': time_queries(session, end_date, args.repeats)}
+    session.close()
+
+    migrate(engine, Base.metadata)
+    session = sessionmaker(bind=engine)()
+    session.execute(text('ANALYZE'))
+    session.commit()
+    results['after'] = time_queries(session, end_date, args.repeats)
+    session.close()
+
+    print(f'{"query":<22} {"before ms":>10} {"after ms":>10}')
+    for name, before in results['before'].items():
+        print(f'{name:<22} {before:>10.3f} {results["after"][name]:>10.3f}')
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
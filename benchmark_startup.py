@@ -0,0 +1,66 @@
+#!/usr/bin/env pipenv-shebang
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from cli import COMMANDS
+
+HEAVY_MODULES = ('garminconnect', 'pygsheets', 'pytz', 'fitparse', 'pyarrow', 'duckdb')
+CLI_PATH = Path(__file__).resolve().parent / 'cli.py'
+
+
+def time_command(command, repeats):
+    """
+    Run a command in a fresh interpreter a few times and see which heavy modules it imported
+
+    :param command: Python arguments to run, without the interpreter (list of str)
+    :param repeats: Times to run it (int)
+
+    :return: seconds, imported: Median wall time and the heavy modules imported with their
+        cumulative import time in ms (float, dict)
+    """
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, *command], cwd=CLI_PATH.parent, check=True, capture_output=True)
+        timings.append(time.perf_counter() - started)
+    # -X importtime writes "import time: self | cumulative | module" lines to stderr
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', *command], cwd=CLI_PATH.parent, check=True,
+                            capture_output=True, text=True).stderr
+    imported = {}
+    for line in stderr.splitlines():
+        parts = [part.strip() for part in line.removeprefix('import time:').split('|')]
+        if len(parts) == 3 and parts[2] in HEAVY_MODULES:
+            imported[parts[2]] = int(parts[1]) / 1000
+    return statistics.median(timings), imported
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(prog='benchmark_startup',
+                                         description='Time how long each cli command takes to start')
+    arg_parser.add_argument('-n', '--repeats', default=5, type=int, help='Runs of each command (default 5)')
+    arg_parser.add_argument('-o', '--output', default=None, help='Save the results to this json file')
+    args = arg_parser.parse_args()
+
+    # --help exits once the command's module is imported and its parser is built, so this is
+    # the startup cost without touching the database or garmin
+    commands = {name: [str(CLI_PATH), name, '--help'] for name in COMMANDS}
+    # every command module plus the libraries they used to import at the top
+    commands['eager'] = ['-c', 'import ' + ', '.join([module_name for module_name, _ in COMMANDS.values()]
+                                                     + ['garminconnect', 'pygsheets', 'pytz', 'fitparse'])]
+    results = {}
+    for name, command in commands.items():
+        seconds, imported = time_command(command, args.repeats)
+        results[name] = {'seconds': round(seconds, 4), 'heavy_imports_ms': imported}
+
+    print(f'{"command":<12} {"startup ms":>11}  heavy imports')
+    for name, result in results.items():
+        heavy = ', '.join(f'{module} {ms:,.0f}ms' for module, ms in result['heavy_imports_ms'].items()) or '-'
+        print(f'{name:<12} {result["seconds"] * 1000:>11.1f}  {heavy}')
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
@@ -0,0 +1,39 @@
+#!/usr/bin/env pipenv-shebang
+import argparse
+import importlib
+import sys
+
+from dotenv import load_dotenv
+
+# modules are only imported once their command is picked so a report doesn't pay for
+# garminconnect, pygsheets and the rest of the sync
+COMMANDS = {
+    'sync': ('get_stats', 'Scrape the garmin stats into the database'),
+    'ytd': ('print_steps_ytd', 'Pretty print the step stats ytd'),
+    'sheet-sync': ('weights_to_gsheet', 'Fill in the weights and distances on the weigh-in sheet'),
+    'reclassify': ('update_existing_ultimate', 'Apply the activity type rules to activities already saved'),
+}
+
+
+def run(argv=None):
+    """
+    Run one of the COMMANDS, everything after the command name is parsed by its module
+
+    :param argv: Command line arguments, sys.argv if not given (list of str)
+    """
+    arg_parser = argparse.ArgumentParser(prog='garmin', description='Garmin export commands')
+    arg_parser.add_argument('command', choices=COMMANDS,
+                            help='; '.join(f'{name}: {description}' for name, (_, description) in COMMANDS.items()))
+    arg_parser.add_argument('arguments', nargs=argparse.REMAINDER, help='Arguments for the command')
+    args = arg_parser.parse_args(argv)
+
+    module_name, description = COMMANDS[args.command]
+    module = importlib.import_module(module_name)
+    command_parser = argparse.ArgumentParser(prog=f'garmin {args.command}', description=description)
+    module.add_arguments(command_parser)
+    module.main(command_parser.parse_args(args.arguments))
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    run(sys.argv[1:])
@@ -0,0 +1,235 @@
+#!/usr/bin/env pipenv-shebang
+import argparse
+import copy
+import datetime as dt
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import razator_utils
+from dotenv import load_dotenv
+from garminconnect import GarminConnectAuthenticationError
+from sqlalchemy.orm import sessionmaker
+
+from activity_details import FitStore, sync_activity_details
+from garmin_client import GarminClient
+from get_stats import login_garmin, sync_range
+from metrics import RUN_METRICS, InstrumentedGarmin
+from migrations import migrate
+from model import Base, create_db_engine
+from response_cache import CachedGarmin, ResponseCache
+from sync_state import incremental_start
+
+SYNC_KINDS = ('poll', 'nightly')
+
+
+class SyncDaemon:
+    """
+    Keeps one logged in garmin session and one database connection pool alive and runs the
+    syncs itself: a light poll of today every few minutes and a nightly reconciliation of the
+    days before it. Syncs can also be triggered through the local HTTP endpoint.
+    """
+
+    def __init__(self, args, logger=razator_utils.log.get_stout_logger('garmin_daemon')):
+        """
+        :param args: Parsed command line arguments (argparse.Namespace)
+        :param logger: Logger object (logging.Logger)
+        """
+        self.args = args
+        self.logger = logger
+        engine = create_db_engine()
+        migrate(engine, Base.metadata, logger)
+        self.session_factory = sessionmaker(bind=engine)
+        self.cache = ResponseCache(os.getenv('GARMIN_CACHE_DIR'),
+                                   max_bytes=int(os.getenv('GARMIN_CACHE_MAX_MB', '1024')) * 1024 ** 2,
+                                   logger=logger)
+        self.fit_store = FitStore(os.getenv('GARMIN_FIT_DIR'))
+        self.api = self.refresh_api = None
+        self.triggers = queue.Queue()
+        # the http threads read the status while the scheduler thread changes it
+        self._status_lock = threading.Lock()
+        self.status = {'started': dt.datetime.now().isoformat(timespec='seconds'), 'running': None,
+                       'last_runs': {}, 'next_runs': {}}
+        self._stop = threading.Event()
+
+    def login(self):
+        api = GarminClient(InstrumentedGarmin(login_garmin()), max_retries=self.args.max_retries,
+                           max_concurrency=self.args.workers, logger=self.logger)
+        self.api = CachedGarmin(api, self.cache)
+        # the nightly reconcile has to see data garmin synced late, which the cache would never expire
+        self.refresh_api = CachedGarmin(api, self.cache, refresh=True)
+
+    def status_snapshot(self):
+        with self._status_lock:
+            return copy.deepcopy(self.status)
+
+    def set_status(self, key, value):
+        with self._status_lock:
+            self.status[key] = value
+
+    def sync(self, kind):
+        """
+        Run one sync with the kept session, logging in again once if garmin dropped it
+
+        :param kind: 'poll' for today or 'nightly' for the days before today (str)
+        """
+        today = dt.date.today()
+        self.set_status('running', kind)
+        started = time.perf_counter()
+        result = {'started': dt.datetime.now().isoformat(timespec='seconds')}
+        session = self.session_factory()
+        try:
+            if kind == 'poll':
+                start_date, end_date = today, today
+            else:
+                end_date = today - dt.timedelta(days=1)
+                start_date = min(today - dt.timedelta(days=self.args.reconcile_days),
+                                 incremental_start(session, end_date))
+            for attempt in range(2):
+                if self.api is None:
+                    self.login()
+                api = self.api if kind == 'poll' else self.refresh_api
+                try:
+                    counts = sync_range(api, session, start_date, end_date, self.logger, self.args.workers,
+                                        chunk_days=self.args.chunk_days, intraday=self.args.intraday)
+                    break
+                except GarminConnectAuthenticationError:
+                    if attempt:
+                        raise
+                    self.logger.warning('Garmin session expired, logging in again')
+                    session.rollback()
+                    self.api = self.refresh_api = None
+            if self.args.details:
+                sync_activity_details(session, api, self.fit_store, self.args.workers, self.logger)
+            result.update(status='ok', rows={table_name: inserted + updated
+                                             for table_name, (inserted, updated) in counts.items()})
+        except Exception as e:
+            self.logger.exception(f'{kind} sync failed')
+            RUN_METRICS.increment('failed_runs')
+            session.rollback()
+            result.update(status='error', error=str(e))
+        finally:
+            session.close()
+        result['seconds'] = round(time.perf_counter() - started, 3)
+        with self._status_lock:
+            self.status['running'] = None
+            self.status['last_runs'][kind] = result
+        RUN_METRICS.observe('daemon_sync', result['seconds'], kind=kind)
+        RUN_METRICS.write_prometheus(self.args.metrics_dir / 'garmin_daemon.prom')
+        self.logger.info(f'{kind} sync {result["status"]} in {result["seconds"]}s')
+
+    def next_nightly(self, now):
+        run_at = now.replace(hour=self.args.nightly_hour, minute=0, second=0, microsecond=0)
+        return run_at if run_at > now else run_at + dt.timedelta(days=1)
+
+    def run_scheduler(self):
+        """
+        Run the scheduled and triggered syncs one at a time until stopped
+        """
+        now = dt.datetime.now()
+        next_runs = {'poll': now, 'nightly': self.next_nightly(now)}
+        while not self._stop.is_set():
+            self.set_status('next_runs', {kind: run_at.isoformat(timespec='seconds')
+                                          for kind, run_at in next_runs.items()})
+            wait = max((min(next_runs.values()) - dt.datetime.now()).total_seconds(), 0)
+            try:
+                kind = self.triggers.get(timeout=wait)
+            except queue.Empty:
+                kind = min(next_runs, key=next_runs.get)
+            if kind is None:
+                break
+            self.sync(kind)
+            now = dt.datetime.now()
+            if kind == 'poll':
+                next_runs['poll'] = now + dt.timedelta(minutes=self.args.poll_minutes)
+            elif next_runs['nightly'] <= now:
+                next_runs['nightly'] = self.next_nightly(now)
+
+    def stop(self):
+        self._stop.set()
+        self.triggers.put(None)
+
+
+def make_handler(daemon):
+    """
+    :param daemon: Daemon the endpoint controls (SyncDaemon)
+
+    :return: Request handler class for the local HTTP endpoint (type)
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, body):
+            payload = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if urlparse(self.path).path != '/health':
+                return self.send_json(404, {'error': 'not found'})
+            self.send_json(200, {'status': 'ok', 'queued': daemon.triggers.qsize(), **daemon.status_snapshot()})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/sync':
+                return self.send_json(404, {'error': 'not found'})
+            kind = parse_qs(url.query).get('kind', ['poll'])[0]
+            if kind not in SYNC_KINDS:
+                return self.send_json(400, {'error': f'kind must be one of {", ".join(SYNC_KINDS)}'})
+            daemon.triggers.put(kind)
+            self.send_json(202, {'queued': kind})
+
+        def log_message(self, format, *args):
+            daemon.logger.debug(format % args)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    arg_parser = argparse.ArgumentParser(prog='garmin_daemon',
+                                         description='Keep a garmin session open and sync on a schedule')
+    arg_parser.add_argument('--host', default='127.0.0.1', help='Address for the trigger endpoint (default 127.0.0.1)')
+    arg_parser.add_argument('--port', default=int(os.getenv('GARMIN_DAEMON_PORT', '8765')), type=int,
+                            help='Port for the trigger endpoint (default GARMIN_DAEMON_PORT or 8765)')
+    arg_parser.add_argument('--poll_minutes', default=15, type=int, help='Minutes between polls of today (default 15)')
+    arg_parser.add_argument('--nightly_hour', default=3, type=int,
+                            help='Hour of the day to reconcile the days before today (default 3)')
+    arg_parser.add_argument('--reconcile_days', default=7, type=int,
+                            help='Days before today the nightly sync pulls again (default 7)')
+    arg_parser.add_argument('-w', '--workers', default=4, type=int, help='Requests to run at the same time')
+    arg_parser.add_argument('-d', '--chunk_days', default=30, type=int, help='Days to commit at a time')
+    arg_parser.add_argument('--max_retries', default=5, type=int,
+                            help='Times to retry a failed or throttled garmin call (default 5)')
+    arg_parser.add_argument('--intraday', action='store_true', help='Also load the intraday series')
+    arg_parser.add_argument('--details', action='store_true', help='Also load the FIT files of new activities')
+    arg_parser.add_argument('-m', '--metrics_dir', default=os.getenv('GARMIN_METRICS_DIR', Path.home() / 'logs'),
+                            type=lambda value: Path(value).expanduser(),
+                            help='Folder for the prometheus .prom file (default GARMIN_METRICS_DIR or ~/logs)')
+    arg_parser.add_argument('-v', '--stout-output', action='store_true', help='Export logging to terminal')
+    args = arg_parser.parse_args()
+
+    if args.stout_output:
+        daemon_logger = razator_utils.log.get_stout_logger('garmin_daemon', 'INFO')
+    else:
+        log_file = Path.home() / 'logs' / 'garmin_daemon.log'
+        log_file.parent.mkdir(exist_ok=True)
+        daemon_logger = razator_utils.log.get_file_logger('garmin_daemon', log_file, 'INFO')
+
+    sync_daemon = SyncDaemon(args, daemon_logger)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(sync_daemon))
+    threading.Thread(target=server.serve_forever, name='garmin_http', daemon=True).start()
+    daemon_logger.info(f'Listening on http://{args.host}:{args.port}')
+    try:
+        sync_daemon.run_scheduler()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sync_daemon.stop()
+        server.shutdown()
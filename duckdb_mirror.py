@@ -0,0 +1,84 @@
+#!/usr/bin/env pipenv-shebang
+import argparse
+import os
+from pathlib import Path
+
+import duckdb
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from model import Activity, GarminStat, StepYearSummary, WeighIn, database_url
+
+MIRROR_MODELS = (GarminStat, Activity, WeighIn, StepYearSummary)
+
+
+def default_mirror_path():
+    return Path(os.getenv('GARMIN_DUCKDB_PATH', '~/.local/share/garmin_export/garmin.duckdb')).expanduser()
+
+
+def attach_source(connection, url):
+    """
+    Attach the main database to a duckdb connection as "source" so it can be read directly
+
+    :param connection: DuckDB connection (duckdb.DuckDBPyConnection)
+    :param url: Url of the main database (sqlalchemy.engine.URL)
+    """
+    if url.get_backend_name() == 'sqlite':
+        connection.execute('INSTALL sqlite; LOAD sqlite')
+        connection.execute(f"ATTACH '{url.database}' AS source (TYPE sqlite, READ_ONLY)")
+        return
+    connection.execute('INSTALL postgres; LOAD postgres')
+    libpq = ' '.join(f'{key}={value}' for key, value in (('host', url.host), ('port', url.port),
+                                                          ('dbname', url.database), ('user', url.username),
+                                                          ('password', url.password)) if value)
+    connection.execute(f"ATTACH '{libpq}' AS source (TYPE postgres, READ_ONLY)")
+
+
+def refresh_mirror(path=None, url=None, models=MIRROR_MODELS):
+    """
+    Copy the tables into a local DuckDB file. DuckDB reads the main database directly so the
+    rows never pass through python.
+
+    :param path: DuckDB file to write, defaults to GARMIN_DUCKDB_PATH (str or pathlib.Path)
+    :param url: Url of the main database, from the environment if not given (sqlalchemy.engine.URL)
+    :param models: Models to copy (iterable of model classes)
+
+    :return: counts: Rows copied keyed by table name (dict of int)
+    """
+    path = Path(path).expanduser() if path else default_mirror_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    counts = {}
+    with duckdb.connect(str(path)) as connection:
+        attach_source(connection, url or database_url())
+        for model in models:
+            table = model.__tablename__
+            connection.execute(f'CREATE OR REPLACE TABLE {table} AS SELECT * FROM source.{table}')
+            counts[table] = connection.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+    return counts
+
+
+def open_mirror(path=None):
+    """
+    Open a session on the DuckDB mirror, the models query it the same way they query the main database
+
+    :param path: DuckDB file to open, defaults to GARMIN_DUCKDB_PATH (str or pathlib.Path)
+
+    :return: Database session (sqlalchemy.orm.Session)
+    """
+    path = Path(path).expanduser() if path else default_mirror_path()
+    engine = create_engine(f'duckdb:///{path}', connect_args={'read_only': True})
+    return sessionmaker(bind=engine)()
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    arg_parser = argparse.ArgumentParser(prog='duckdb_mirror',
+                                         description='Copy the garmin tables into a local DuckDB file for analysis')
+    arg_parser.add_argument('-p', '--path', default=None,
+                            help='DuckDB file to write (default GARMIN_DUCKDB_PATH or '
+                                 '~/.local/share/garmin_export/garmin.duckdb)')
+    args = arg_parser.parse_args()
+
+    for table_name, count in refresh_mirror(args.path).items():
+        print(f'{table_name}: {count:,} rows')
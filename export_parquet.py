@@ -0,0 +1,175 @@
+#!/usr/bin/env pipenv-shebang
+import argparse
+import datetime as dt
+import json
+import os
+import shutil
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import razator_utils
+from dotenv import load_dotenv
+from sqlalchemy import BIGINT, Boolean, Date, DateTime, Float, Integer, SmallInteger, extract, func, select
+
+from metrics import write_text_atomic
+from model import Base, init_db
+
+MANIFEST_NAME = '_manifest.json'
+
+
+def export_models():
+    """
+    :return: Models that have a __partition_column__ to split them up by year (list of model classes)
+    """
+    return sorted((mapper.class_ for mapper in Base.registry.mappers if hasattr(mapper.class_, '__partition_column__')),
+                  key=lambda model: model.__tablename__)
+
+
+def arrow_type(column):
+    """
+    :param column: Column to convert (sqlalchemy.Column)
+
+    :return: Arrow type for the column (pyarrow.DataType)
+    """
+    column_type = column.type
+    if isinstance(column_type, BIGINT):
+        return pa.int64()
+    if isinstance(column_type, SmallInteger):
+        return pa.int16()
+    if isinstance(column_type, Integer):
+        return pa.int32()
+    if isinstance(column_type, Float):
+        return pa.float64()
+    if isinstance(column_type, Boolean):
+        return pa.bool_()
+    if isinstance(column_type, DateTime):
+        return pa.timestamp('us', tz='UTC' if column_type.timezone else None)
+    if isinstance(column_type, Date):
+        return pa.date32()
+    return pa.string()
+
+
+def arrow_schema(model):
+    return pa.schema([pa.field(column.name, arrow_type(column), nullable=column.nullable)
+                      for column in model.__table__.columns])
+
+
+def year_fingerprints(session, model):
+    """
+    Count the rows in each year and find the last time one of them changed. Tables without an
+    updated_at column use the latest partition column value instead.
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param model: Model to look at (model class)
+
+    :return: fingerprints: Row count and last change keyed by year, None for rows without a date (dict)
+    """
+    table = model.__table__
+    partition_column = table.c[model.__partition_column__]
+    changed_column = table.c['updated_at'] if 'updated_at' in table.c else partition_column
+    year = extract('year', partition_column)
+    rows = session.execute(select(year, func.count(), func.max(changed_column)).group_by(year))
+    return {int(row_year) if row_year is not None else None: {'rows': count, 'changed': str(changed)}
+            for row_year, count, changed in rows}
+
+
+def partition_dir(output_dir, table_name, year):
+    return Path(output_dir) / table_name / f'year={"unknown" if year is None else year}'
+
+
+def write_partition(session, model, year, output_dir, batch_size=50000):
+    """
+    Write one year of a table to parquet, streaming the rows out of the database in batches
+    that are converted to arrow a column at a time
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param model: Model to export (model class)
+    :param year: Year to export, None for the rows without a date (int)
+    :param output_dir: Root folder of the export (pathlib.Path)
+    :param batch_size: Rows to convert at a time (int)
+
+    :return: rows: Number of rows written (int)
+    """
+    table = model.__table__
+    partition_column = table.c[model.__partition_column__]
+    schema = arrow_schema(model)
+    if year is None:
+        where = partition_column.is_(None)
+    elif isinstance(partition_column.type, DateTime):
+        where = partition_column.between(dt.datetime(year, 1, 1), dt.datetime(year, 12, 31, 23, 59, 59, 999999))
+    else:
+        where = partition_column.between(dt.date(year, 1, 1), dt.date(year, 12, 31))
+
+    target_dir = partition_dir(output_dir, table.name, year)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = target_dir / 'part-0.parquet.tmp'
+    rows = 0
+    result = session.execute(select(table).where(where).order_by(partition_column)
+                             .execution_options(stream_results=True, yield_per=batch_size))
+    with pq.ParquetWriter(tmp_path, schema, compression='zstd') as writer:
+        for batch in result.partitions():
+            columns = zip(*batch)
+            writer.write_batch(pa.record_batch([pa.array(values, type=field.type)
+                                                for values, field in zip(columns, schema)], schema=schema))
+            rows += len(batch)
+    os.replace(tmp_path, target_dir / 'part-0.parquet')
+    return rows
+
+
+def export_parquet(session, output_dir, models=None, full=False,
+                   logger=razator_utils.log.get_stout_logger('garmin_parquet')):
+    """
+    Export tables to parquet split up by year. Only the years whose row count or last change
+    differ from the manifest of the last export are written again.
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param output_dir: Root folder of the export (str or pathlib.Path)
+    :param models: Models to export, every model with a __partition_column__ if not given (list of model classes)
+    :param full: Rewrite every year even if it hasn't changed (bool)
+    :param logger: Logger object (logging.Logger)
+
+    :return: written: Years written keyed by table name (dict of lists)
+    """
+    output_dir = Path(output_dir).expanduser()
+    manifest_path = output_dir / MANIFEST_NAME
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    written = {}
+    for model in models or export_models():
+        table_name = model.__tablename__
+        fingerprints = {str(year): (year, fingerprint)
+                        for year, fingerprint in year_fingerprints(session, model).items()}
+        exported = manifest.get(table_name, {})
+        written[table_name] = []
+        for key, (year, fingerprint) in fingerprints.items():
+            if not full and exported.get(key) == fingerprint:
+                continue
+            rows = write_partition(session, model, year, output_dir)
+            written[table_name].append(year)
+            logger.info(f'{table_name} {key}: wrote {rows:,} rows')
+        for key in set(exported) - set(fingerprints):
+            shutil.rmtree(partition_dir(output_dir, table_name, None if key == 'None' else int(key)),
+                          ignore_errors=True)
+        manifest[table_name] = {key: fingerprint for key, (_, fingerprint) in fingerprints.items()}
+        # save after each table so an interrupted export doesn't redo the tables it finished
+        write_text_atomic(manifest_path, json.dumps(manifest, indent=2))
+    return written
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    arg_parser = argparse.ArgumentParser(prog='export_parquet',
+                                         description='Export the garmin tables to parquet partitioned by year')
+    arg_parser.add_argument('-o', '--output_dir', default=os.getenv('GARMIN_PARQUET_DIR', '~/garmin_parquet'),
+                            help='Folder for the export (default GARMIN_PARQUET_DIR or ~/garmin_parquet)')
+    arg_parser.add_argument('-t', '--tables', nargs='+', default=None,
+                            help='Tables to export (default all of them)')
+    arg_parser.add_argument('--full', action='store_true', help='Rewrite every partition')
+    args = arg_parser.parse_args()
+
+    session = init_db()
+    models = [model for model in export_models() if not args.tables or model.__tablename__ in args.tables]
+    counts = export_parquet(session, args.output_dir, models, args.full)
+    session.close()
+    print(f'Wrote {sum(len(years) for years in counts.values())} partitions')
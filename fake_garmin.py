@@ -0,0 +1,200 @@
+import datetime as dt
+import random
+import threading
+import time
+from collections import Counter
+
+
+class FakeGarminError(Exception):
+    """
+    Error raised by FakeGarmin when it is told to fail a call
+    """
+
+
+class FakeResponse:
+    """
+    Just enough of a requests.Response for the retry logic to read
+    """
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeGarminThrottled(FakeGarminError):
+    """
+    Error raised by FakeGarmin when it pretends garmin sent back a 429
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.response = FakeResponse(429, {'Retry-After': str(retry_after)})
+
+
+def synthetic_activity(activity_id, start_time, rand):
+    """
+    Make a raw activity shaped like the ones from api.get_activities_by_date
+
+    :param activity_id: Id for the activity (int)
+    :param start_time: Local start time of the activity (datetime.datetime)
+    :param rand: Source of the random values (random.Random)
+
+    :return: activity: Raw activity (dict)
+    """
+    distance = rand.uniform(1000, 20000)
+    duration = distance / rand.uniform(2, 4)
+    return {
+        'activityId': activity_id, 'activityName': rand.choice(['Morning Run', 'Frisbee', 'Walk']),
+        'description': None, 'startTimeLocal': start_time.isoformat(sep=' '),
+        'startTimeGMT': (start_time + dt.timedelta(hours=7)).isoformat(sep=' '),
+        'activityType': {'typeId': rand.choice([1, 11, 213]), 'typeKey': 'running', 'parentTypeId': 17,
+                         'isHidden': False, 'trimmable': True, 'restricted': False, 'sortOrder': 3},
+        'eventType': {'typeId': 9, 'typeKey': 'uncategorized', 'sortOrder': 10},
+        'distance': distance, 'duration': duration, 'movingDuration': duration * 0.95,
+        'elevationGain': rand.uniform(0, 300), 'elevationLoss': rand.uniform(0, 300),
+        'averageSpeed': distance / duration, 'maxSpeed': distance / duration * 1.5,
+        'calories': rand.uniform(100, 1500), 'averageHR': rand.uniform(100, 170), 'maxHR': rand.uniform(150, 195),
+        'steps': rand.randint(1000, 30000), 'timeZoneId': 149,
+        'beginTimestamp': int(start_time.timestamp() * 1000), 'vO2MaxValue': rand.uniform(40, 55),
+        'workoutId': None, 'deviceId': 3415672351, 'minElevation': 1500.0, 'maxElevation': 1700.0,
+        'locationName': 'Salt Lake City', 'lapCount': rand.randint(1, 20), 'caloriesConsumed': None,
+        'minActivityLapDuration': 300.0, 'hasSplits': False, 'moderateIntensityMinutes': rand.randint(0, 30),
+        'vigorousIntensityMinutes': rand.randint(0, 60), 'pr': False, 'manualActivity': False,
+        'autoCalcCalories': False, 'elevationCorrected': 'false', 'summarizedDiveInfo': {'summarizedDiveGases': []},
+        'splitSummaries': [{'noOfSplits': 1, 'totalAscent': 10.0, 'duration': duration}],
+    }
+
+
+class FakeGarmin:
+    """
+    Local stand in for garminconnect.Garmin that makes up data instead of calling garmin.
+
+    The data for a day only depends on the seed and the date so repeated calls agree with
+    each other. Every call can be slowed down with latency, made to fail at error_rate and
+    throttled at throttle_rate.
+    """
+
+    def __init__(self, seed=0, latency=0.0, error_rate=0.0, activities_per_day=1.0, weigh_in_rate=0.5,
+                 throttle_rate=0.0, retry_after=1):
+        """
+        :param seed: Seed for the made up data (int)
+        :param latency: Seconds each call takes (float)
+        :param error_rate: Chance each call raises a FakeGarminError (float)
+        :param activities_per_day: Average activities made up for each day (float)
+        :param weigh_in_rate: Chance a day has a weigh-in (float)
+        :param throttle_rate: Chance each call raises a FakeGarminThrottled (float)
+        :param retry_after: Seconds to put in the Retry-After of throttled calls (int)
+        """
+        self.seed = seed
+        self.latency = latency
+        self.error_rate = error_rate
+        self.activities_per_day = activities_per_day
+        self.weigh_in_rate = weigh_in_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.activity_types = {}
+        self._errors = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _day_random(self, day, kind):
+        return random.Random(f'{self.seed}-{kind}-{day.isoformat()}')
+
+    def _call(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
+            fail = self._errors.random() < self.error_rate
+            throttle = self._errors.random() < self.throttle_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if throttle:
+            raise FakeGarminThrottled(f'Injected 429 in {endpoint}', self.retry_after)
+        if fail:
+            raise FakeGarminError(f'Injected failure in {endpoint}')
+
+    @staticmethod
+    def _days(startdate, enddate):
+        start_date, end_date = dt.date.fromisoformat(startdate), dt.date.fromisoformat(enddate)
+        return (start_date + dt.timedelta(days=i) for i in range((end_date - start_date).days + 1))
+
+    def login(self, tokenstore=None):
+        self._call('login')
+
+    def get_stats(self, cdate):
+        self._call('get_stats')
+        rand = self._day_random(dt.date.fromisoformat(cdate), 'stats')
+        steps = rand.randint(2000, 25000)
+        return {
+            'calendarDate': cdate, 'wellnessActiveKilocalories': rand.randint(100, 1500),
+            'bmrKilocalories': 1900, 'remainingKilocalories': rand.randint(0, 3000),
+            'wellnessKilocalories': rand.randint(2000, 3500), 'totalSteps': steps, 'dailyStepGoal': 10000,
+            'wellnessDistanceMeters': int(steps * 0.75), 'totalKilocalories': rand.randint(2000, 3500),
+            'activeKilocalories': rand.randint(100, 1500), 'totalDistanceMeters': int(steps * 0.75),
+            'moderateIntensityMinutes': rand.randint(0, 60), 'vigorousIntensityMinutes': rand.randint(0, 60),
+            'floorsAscended': rand.randint(0, 30), 'floorsDescended': rand.randint(0, 30),
+            'intensityMinutesGoal': 150, 'userFloorsAscendedGoal': 10, 'minHeartRate': rand.randint(40, 55),
+            'maxHeartRate': rand.randint(120, 190), 'restingHeartRate': rand.randint(45, 60),
+            'averageStressLevel': rand.randint(10, 50), 'maxStressLevel': rand.randint(50, 99),
+            'minAvgHeartRate': rand.randint(40, 55), 'maxAvgHeartRate': rand.randint(100, 180),
+            'bodyBatteryChargedValue': rand.randint(10, 90), 'bodyBatteryDrainedValue': rand.randint(10, 90),
+            'abnormalHeartRateAlertsCount': None,
+        }
+
+    def get_activities_by_date(self, startdate, enddate, activitytype=None):
+        self._call('get_activities_by_date')
+        activities = []
+        for day in self._days(startdate, enddate):
+            rand = self._day_random(day, 'activities')
+            count = int(self.activities_per_day) + (rand.random() < self.activities_per_day % 1)
+            for i in range(count):
+                activity_id = day.toordinal() * 100 + i
+                start_time = dt.datetime.combine(day, dt.time(6 + i * 3, rand.randint(0, 59)))
+                activity = synthetic_activity(activity_id, start_time, rand)
+                if activity_id in self.activity_types:
+                    activity['activityType'].update(self.activity_types[activity_id])
+                activities.append(activity)
+        # garmin sends the newest activities first
+        return activities[::-1]
+
+    def get_weigh_ins(self, startdate, enddate):
+        self._call('get_weigh_ins')
+        summaries = []
+        for day in self._days(startdate, enddate):
+            rand = self._day_random(day, 'weigh_ins')
+            if rand.random() >= self.weigh_in_rate:
+                continue
+            timestamp = int(dt.datetime.combine(day, dt.time(13, rand.randint(0, 59))).timestamp() * 1000)
+            summaries.append({'summaryDate': day.isoformat(), 'allWeightMetrics': [{
+                'samplePk': timestamp, 'date': timestamp, 'calendarDate': day.isoformat(),
+                'weight': rand.uniform(75000, 85000), 'timestampGMT': timestamp,
+            }]})
+        return {'dailyWeightSummaries': summaries[::-1]}
+
+    def _day_samples(self, cdate, kind, interval, low, high):
+        rand = self._day_random(dt.date.fromisoformat(cdate), kind)
+        start = int(dt.datetime.combine(dt.date.fromisoformat(cdate), dt.time(), dt.timezone.utc).timestamp() * 1000)
+        return [[start + i * interval * 1000, rand.randint(low, high)] for i in range(86400 // interval)]
+
+    def get_heart_rates(self, cdate):
+        self._call('get_heart_rates')
+        return {'calendarDate': cdate, 'heartRateValues': self._day_samples(cdate, 'heart_rate', 120, 45, 170)}
+
+    def get_stress_data(self, cdate):
+        self._call('get_stress_data')
+        battery = self._day_samples(cdate, 'body_battery', 180, 5, 100)
+        return {'calendarDate': cdate, 'stressValuesArray': self._day_samples(cdate, 'stress', 180, -1, 99),
+                'bodyBatteryValuesArray': [[millis, 'MEASURED', level, 2.0] for millis, level in battery]}
+
+    def get_steps_data(self, cdate):
+        self._call('get_steps_data')
+        start = dt.datetime.combine(dt.date.fromisoformat(cdate), dt.time())
+        return [{'startGMT': (start + dt.timedelta(minutes=15 * i)).isoformat() + '.0',
+                 'endGMT': (start + dt.timedelta(minutes=15 * (i + 1))).isoformat() + '.0',
+                 'steps': steps, 'primaryActivityLevel': 'active' if steps > 500 else 'sedentary'}
+                for i, (_, steps) in enumerate(self._day_samples(cdate, 'steps', 900, 0, 1500))]
+
+    def set_activity_type(self, activity_id, type_id, type_key, parent_type_id):
+        self._call('set_activity_type')
+        with self._lock:
+            self.activity_types[activity_id] = {'typeId': type_id, 'typeKey': type_key,
+                                                'parentTypeId': parent_type_id}
@@ -0,0 +1,183 @@
+import datetime as dt
+import email.utils
+import functools
+import random
+import threading
+import time
+
+import razator_utils
+
+from metrics import RUN_METRICS
+from rate_limit import TokenBucket
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit that halves when garmin throttles us and creeps back up by about one
+    slot for every limit's worth of calls that succeed (additive increase, multiplicative decrease)
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        """
+        :param max_limit: Most calls allowed at the same time (int)
+        :param min_limit: Fewest calls allowed at the same time (int)
+        """
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.limit = float(self.max_limit)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        with self._condition:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            self.limit = max(self.min_limit, self.limit / 2)
+
+
+def _find_response(error):
+    # garminconnect wraps the requests error so look down the exception chain for the response
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if getattr(error, 'response', None) is not None:
+            return error.response
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def retry_after_seconds(response):
+    """
+    Read the Retry-After header from a response
+
+    :param response: Response garmin sent (requests.Response)
+
+    :return: seconds: Seconds garmin asked us to wait, None if it didn't say (float)
+    """
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - dt.datetime.now(dt.timezone.utc)).total_seconds(), 0)
+
+
+def classify_error(error):
+    """
+    Work out if a failed call should be retried
+
+    :param error: Exception the call raised (Exception)
+
+    :return: kind: 'throttled', 'transient' or 'fatal' (str)
+    """
+    # imported here so the commands that never call garmin don't load garminconnect
+    from garminconnect import GarminConnectAuthenticationError, GarminConnectTooManyRequestsError
+
+    if isinstance(error, GarminConnectTooManyRequestsError):
+        return 'throttled'
+    if isinstance(error, GarminConnectAuthenticationError):
+        return 'fatal'
+    response = _find_response(error)
+    status = getattr(response, 'status_code', None)
+    if status == 429:
+        return 'throttled'
+    if status is not None and 400 <= status < 500 and status not in (408, 425):
+        return 'fatal'
+    return 'transient'
+
+
+class GarminClient:
+    """
+    Wraps the Garmin API class so every call is retried with jittered exponential backoff,
+    honours Retry-After when garmin throttles us, and runs under an adaptive concurrency limit
+    and an optional requests per second limit
+    """
+
+    def __init__(self, api, max_retries=5, base_delay=1.0, max_delay=120.0, max_concurrency=4, rate_limit=None,
+                 logger=razator_utils.log.get_stout_logger('garmin_client')):
+        """
+        :param api: garmin API Class (Garmin)
+        :param max_retries: Times to retry a call before giving up (int)
+        :param base_delay: Seconds to back off after the first failure, doubles after each one (float)
+        :param max_delay: Longest time to back off (float)
+        :param max_concurrency: Most calls allowed at the same time (int)
+        :param rate_limit: Max requests per second to garmin across every endpoint, unlimited if not set (float)
+        :param logger: Logger object (logging.Logger)
+        """
+        self.api = api
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiter = AdaptiveLimiter(max_concurrency)
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.logger = logger
+
+    def backoff(self, attempt):
+        """
+        :param attempt: Number of failures so far, starting at 0 (int)
+
+        :return: seconds: Random time between 0 and the capped exponential backoff (float)
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, endpoint, func, *args, **kwargs):
+        """
+        Call an API method with retries
+
+        :param endpoint: Name of the method for logging (str)
+        :param func: Method to call (callable)
+
+        :return: The method's result
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.bucket:
+                self.bucket.acquire()
+            self.limiter.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                error = e
+            else:
+                self.limiter.on_success()
+                return result
+            finally:
+                self.limiter.release()
+
+            kind = classify_error(error)
+            if kind == 'fatal' or attempt == self.max_retries:
+                raise error
+            delay = self.backoff(attempt)
+            if kind == 'throttled':
+                self.limiter.on_throttle()
+                delay = max(delay, retry_after_seconds(_find_response(error)) or 0)
+            delay = min(delay, self.max_delay)
+            RUN_METRICS.increment('retries', endpoint=endpoint, reason=kind)
+            self.logger.warning(f'{endpoint} failed ({kind}: {error}), retry {attempt + 1} of {self.max_retries} '
+                                f'in {delay:.1f}s, concurrency limit {int(self.limiter.limit)}')
+            time.sleep(delay)
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if not callable(attr):
+            return attr
+        return functools.partial(self.call, name, attr)
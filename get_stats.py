@@ -2,152 +2,205 @@
 import argparse
 import datetime as dt
 import os
-import pytz
 import sys
+import time
 from pathlib import Path
 
 import razator_utils
 from dotenv import load_dotenv
-from garminconnect import Garmin
 
-from model import GarminStat, Activity, WeighIn, init_db
+from activity_details import FitStore, reparse_store, sync_activity_details
+from activity_schema import ACTIVITY_FLATTENER
+from garmin_client import GarminClient
+from intraday import load_intraday, replay_intraday
+from metrics import RUN_METRICS, InstrumentedGarmin, timed
+from model import DEFAULT_ACCOUNT, GarminStat, Activity, WeighIn, init_db
+from parallel import ordered_map
+from reclassify import reclassified_ids, reclassify_activities
+from response_cache import CachedGarmin, ResponseCache
+from step_summary import refresh_step_summary
+from sync_state import date_chunks, incremental_start, record_progress, resume_start
+from upsert import write_stream
+
+
+DAY_OF_WEEK = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+DAILY_COLUMN_MAPPING = {
+    'wellness_active_calories': 'wellnessActiveKilocalories',
+    'wellness_bmr_calories': 'bmrKilocalories',
+    'food_calories_remaining': 'remainingKilocalories',
+    'wellness_total_calories': 'wellnessKilocalories',
+    'total_steps': 'totalSteps',
+    'step_goal': 'dailyStepGoal',
+    'wellness_total_distance': 'wellnessDistanceMeters',
+    'wellness_average_steps': '',
+    'common_total_calories': 'totalKilocalories',
+    'common_active_calories': 'activeKilocalories',
+    'common_total_distance': 'totalDistanceMeters',
+    'wellness_moderate_intensity_minutes': 'moderateIntensityMinutes',
+    'wellness_vigorous_intensity_minutes': 'vigorousIntensityMinutes',
+    'wellness_floors_ascended': 'floorsAscended',
+    'wellness_floors_descended': 'floorsDescended',
+    'wellness_user_intensity_minutes_goal': 'intensityMinutesGoal',
+    'wellness_user_floors_ascended_goal': 'userFloorsAscendedGoal',
+    'wellness_min_heart_rate': 'minHeartRate',
+    'wellness_max_heart_rate': 'maxHeartRate',
+    'wellness_resting_heart_rate': 'restingHeartRate',
+    'wellness_average_stress': 'averageStressLevel',
+    'wellness_max_stress': 'maxStressLevel',
+    'wellness_min_avg_heart_rate': 'minAvgHeartRate',
+    'wellness_max_avg_heart_rate': 'maxAvgHeartRate',
+    'wellness_bodybattery_charged': 'bodyBatteryChargedValue',
+    'wellness_bodybattery_drained': 'bodyBatteryDrainedValue',
+    'wellness_abnormalhr_alerts_count': 'abnormalHeartRateAlertsCount'
+}
+
+
+@timed('transform_daily_stats')
+def transform_daily_stats(check_day, day_stats):
+    """
+    Turn the raw garmin stats for a day into a daily_stats row
+
+    :param check_day: Day the stats are for (datetime.date)
+    :param day_stats: Raw response from api.get_stats (dict)
+
+    :return: day_data: Daily stats row (dict)
+    """
+    # TODO: go through and get new stats model
+    day_data = {'date': check_day, 'day_of_week': DAY_OF_WEEK[check_day.weekday()],
+                'wellness_average_steps': 0}
+    day_data = {**day_data, **{k: day_stats[v] if day_stats[v] else 0
+                               for k, v in DAILY_COLUMN_MAPPING.items() if v}}
+    abnormal_hr_counts = day_stats['abnormalHeartRateAlertsCount']
+    day_data['wellness_abnormalhr_alerts_count'] = abnormal_hr_counts if abnormal_hr_counts else 0
+    return day_data
 
 
-def get_daily_stats(api, start_date, end_date):
+def iter_daily_stats(api, start_date, end_date, workers=1):
     """
-    Get the daily stats from garmin
+    Get the daily stats from garmin one day at a time
 
     :param api: garmin API Class (Garmin)
     :param start_date: Start date for activities (datetime.date)
     :param end_date: End date for activities (datetime.date)
+    :param workers: Number of days to request from garmin at the same time (int)
 
-    :return: garmin_data: List of daily stats pulled from garmin (list of dicts)
+    :return: Generator of daily stats rows in date order (dicts)
     """
     start_date = max(start_date, dt.date(2017, 9, 5))
 
-    day_of_week = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-    column_mapping = {
-        'wellness_active_calories': 'wellnessActiveKilocalories',
-        'wellness_bmr_calories': 'bmrKilocalories',
-        'food_calories_remaining': 'remainingKilocalories',
-        'wellness_total_calories': 'wellnessKilocalories',
-        'total_steps': 'totalSteps',
-        'step_goal': 'dailyStepGoal',
-        'wellness_total_distance': 'wellnessDistanceMeters',
-        'wellness_average_steps': '',
-        'common_total_calories': 'totalKilocalories',
-        'common_active_calories': 'activeKilocalories',
-        'common_total_distance': 'totalDistanceMeters',
-        'wellness_moderate_intensity_minutes': 'moderateIntensityMinutes',
-        'wellness_vigorous_intensity_minutes': 'vigorousIntensityMinutes',
-        'wellness_floors_ascended': 'floorsAscended',
-        'wellness_floors_descended': 'floorsDescended',
-        'wellness_user_intensity_minutes_goal': 'intensityMinutesGoal',
-        'wellness_user_floors_ascended_goal': 'userFloorsAscendedGoal',
-        'wellness_min_heart_rate': 'minHeartRate',
-        'wellness_max_heart_rate': 'maxHeartRate',
-        'wellness_resting_heart_rate': 'restingHeartRate',
-        'wellness_average_stress': 'averageStressLevel',
-        'wellness_max_stress': 'maxStressLevel',
-        'wellness_min_avg_heart_rate': 'minAvgHeartRate',
-        'wellness_max_avg_heart_rate': 'maxAvgHeartRate',
-        'wellness_bodybattery_charged': 'bodyBatteryChargedValue',
-        'wellness_bodybattery_drained': 'bodyBatteryDrainedValue',
-        'wellness_abnormalhr_alerts_count': 'abnormalHeartRateAlertsCount'
-    }
+    def fetch_day(check_day):
+        return check_day, api.get_stats(check_day.isoformat())
 
-    # TODO: go through and get new stats model
-    garmin_data = []
-    for i in range((end_date - start_date).days + 1):
-        check_day = start_date + dt.timedelta(days=i)
-        day_data = {'date': check_day, 'day_of_week': day_of_week[check_day.weekday()],
-                    'wellness_average_steps': 0}
-        day_stats = api.get_stats(check_day.isoformat())
-        day_data = {**day_data, **{k: day_stats[v] if day_stats[v] else 0
-                                   for k, v in column_mapping.items() if v}}
-        abnormal_hr_counts = day_stats['abnormalHeartRateAlertsCount']
-        day_data['wellness_abnormalhr_alerts_count'] = abnormal_hr_counts if abnormal_hr_counts else 0
-        garmin_data.append(day_data)
+    days = (start_date + dt.timedelta(days=i) for i in range((end_date - start_date).days + 1))
+    for check_day, day_stats in ordered_map(fetch_day, days, workers):
+        yield transform_daily_stats(check_day, day_stats)
 
-    return garmin_data
+
+@timed('transform_activities')
+def flatten_activities(acts):
+    """
+    Flatten the raw garmin activities into activities rows
+
+    :param acts: Raw response from api.get_activities_by_date (list of dicts)
+
+    :return: flat_activities: Activity rows (list of dicts)
+    """
+    return ACTIVITY_FLATTENER.flatten_all(acts)
 
 
-def get_garmin_activities(api, start_date, end_date,
-                          logger=razator_utils.log.get_stout_logger('garmin_activities')):
+def activity_windows(start_date, end_date, window='month'):
     """
-    Get the activities from garmin
+    Split a date range into the windows activities are pulled in
+
+    :param start_date: Start date of the range (datetime.date)
+    :param end_date: End date of the range (datetime.date)
+    :param window: Calendar 'month', calendar 'year' or a number of days (str or int)
+
+    :return: Generator of (window_start, window_end) tuples (datetime.date, datetime.date)
+    """
+    window_start = start_date
+    while window_start <= end_date:
+        if window == 'month':
+            next_start = (window_start.replace(day=1) + dt.timedelta(days=32)).replace(day=1)
+        elif window == 'year':
+            next_start = dt.date(window_start.year + 1, 1, 1)
+        else:
+            next_start = window_start + dt.timedelta(days=int(window))
+        window_end = min(next_start - dt.timedelta(days=1), end_date)
+        yield window_start, window_end
+        window_start = window_end + dt.timedelta(days=1)
+
+
+def get_activity_window(api, window_start, window_end,
+                        logger=razator_utils.log.get_stout_logger('garmin_activities')):
+    """
+    Pull the raw activities for one window. Failed calls are retried by the GarminClient.
 
     :param api: garmin API Class (Garmin)
-    :param start_date: Start date for activities (datetime.date)
-    :param end_date: End date for activities (datetime.date)
+    :param window_start: Start date of the window (datetime.date)
+    :param window_end: End date of the window (datetime.date)
     :param logger: Logger object (logging.Logger)
 
-    :return: activities: List of activities pulled from garmin (list of dicts)
+    :return: acts: Raw response from api.get_activities_by_date (list of dicts)
     """
-    start_date = max(start_date, dt.date(2013, 9, 1))
-    acts = api.get_activities_by_date(start_date.isoformat(), end_date.isoformat())
-
-    logger.info(f'Pulled {len(acts)} activities')
-
-    keep_cols = [
-        'activityId', 'activityName', 'startTimeLocal', 'startTimeGMT',
-        'activityType', 'eventType', 'distance', 'duration',
-        'movingDuration', 'elevationGain', 'elevationLoss', 'averageSpeed',
-        'maxSpeed', 'calories',
-        'averageHR', 'maxHR',
-        'steps', 'timeZoneId',
-        'beginTimestamp', 'vO2MaxValue', 'workoutId', 'deviceId',
-        'minElevation', 'maxElevation', 'locationName', 'lapCount',
-        'caloriesConsumed',
-        'minActivityLapDuration', 'hasSplits',
-        'moderateIntensityMinutes', 'vigorousIntensityMinutes',
-        'pr', 'manualActivity', 'autoCalcCalories', 'elevationCorrected']
-    time_columns = ['startTimeLocal', 'startTimeGMT']
-    flat_activities = []
-    while acts:
-        flat_act = razator_utils.flatten_dict({k: v for k, v in acts.pop(0).items() if k in keep_cols})
-        rename_columns = {col: razator_utils.camel_to_snake(col) for col in flat_act.keys()}
-        for col in time_columns:
-            flat_act[col] = dt.datetime.fromisoformat(flat_act[col])
-        flat_act = {rename_columns.get(k, k): v for k, v in flat_act.items()}
-        if 'activity_type_sort_order' in flat_act.keys():
-            del flat_act['activity_type_sort_order']
-        flat_activities.append(flat_act)
-    ultimate_acts = [flat_act for flat_act in flat_activities
-                     if flat_act['activity_type_type_id'] == 11 and 'Frisbee' in flat_act['activity_name']]
-    for ulti_act in ultimate_acts:
-        api.set_activity_type(
-            activity_id = ulti_act['activity_id'],
-            type_id = 213,
-            type_key='ultimate_disc',
-            parent_type_id=206
-        )
-        ulti_act['activity_type_type_id'] = 213
-        ulti_act['activity_type_type_key'] = 'ultimate_disc'
-        ulti_act['activity_type_parent_type_id'] = 206
-        logger.info(f'Updated activity {ulti_act["activity_id"]} to ultimate')
-    return flat_activities
-
-
-def get_weigh_ins(api, start_date, end_date,
-                  logger=razator_utils.log.get_stout_logger('garmin_activities')):
-    """
-    Get the activities from garmin
+    started = time.monotonic()
+    acts = api.get_activities_by_date(window_start.isoformat(), window_end.isoformat())
+    logger.info(f'Pulled {len(acts)} activities for {window_start} to {window_end} '
+                f'in {time.monotonic() - started:.2f}s')
+    return acts
+
+
+def iter_garmin_activities(api, start_date, end_date,
+                           logger=razator_utils.log.get_stout_logger('garmin_activities'),
+                           window='month', workers=1, skip_ids=()):
+    """
+    Get the activities from garmin one at a time. The range is pulled in windows, several
+    at once if workers is more than 1, and comes back in start_time_local order.
 
     :param api: garmin API Class (Garmin)
-    :param logger: Logger object (logging.Logger)
     :param start_date: Start date for activities (datetime.date)
     :param end_date: End date for activities (datetime.date)
+    :param logger: Logger object (logging.Logger)
+    :param window: Size of each window, see activity_windows (str or int)
+    :param workers: Number of windows to pull at the same time (int)
+    :param skip_ids: Activities already reclassified in garmin, see reclassify_activities (set of int)
 
-    :return: activities: List of weigh-ins pulled from garmin (list of dicts)
+    :return: Generator of activity rows (dicts)
     """
-    logger.info('Getting weigh-ins')
-    start_date = max(start_date, dt.date(2017, 1, 13))
-    raw_weigh_ins = api.get_weigh_ins(start_date.isoformat(), end_date.isoformat())
+    start_date = max(start_date, dt.date(2013, 9, 1))
+
+    def fetch_window(date_window):
+        return get_activity_window(api, *date_window, logger)
+
+    seen_ids = set()
+    pulled = 0
+    for acts in ordered_map(fetch_window, activity_windows(start_date, end_date, window), workers):
+        flat_activities = []
+        for flat_act in sorted(flatten_activities(acts), key=lambda act: act['start_time_local']):
+            if flat_act['activity_id'] not in seen_ids:
+                seen_ids.add(flat_act['activity_id'])
+                flat_activities.append(flat_act)
+        reclassify_activities(api, flat_activities, workers=workers, logger=logger, skip_ids=skip_ids)
+        pulled += len(flat_activities)
+        yield from flat_activities
+
+    logger.info(f'Pulled {pulled} activities')
+
+
+@timed('transform_weigh_ins')
+def transform_weigh_ins(raw_weigh_ins):
+    """
+    Turn the raw garmin weigh-ins into weigh_ins rows
+
+    :param raw_weigh_ins: Raw response from api.get_weigh_ins (dict)
+
+    :return: weigh_ins: Weigh-in rows (list of dicts)
+    """
+    import pytz
+
     weigh_ins_list = []
     for weight_day in raw_weigh_ins['dailyWeightSummaries']:
         weigh_ins_list += weight_day['allWeightMetrics']
-    logger.info(f'Found {len(weigh_ins_list)} weigh-ins')
     weigh_ins = []
     for weigh_in in weigh_ins_list:
         if timestamp_gmt := weigh_in['timestampGMT']:
@@ -156,7 +209,7 @@ def get_weigh_ins(api, start_date, end_date,
             timestamp_utc = dt.datetime.utcfromtimestamp(weigh_in['date'] / 1000)
         timestamp_utc = pytz.utc.localize(timestamp_utc)
         weigh_ins.append({
-            "weigh_in_id": weigh_in['samplePk'],
+            "weigh_in_id": str(weigh_in['samplePk']),
             "weight_timestamp_utc": timestamp_utc,
             "weight_timestamp_mountain": timestamp_utc.astimezone(pytz.timezone('America/Denver')),
             "calendar_date": dt.date.fromisoformat(weigh_in['calendarDate']),
@@ -166,30 +219,248 @@ def get_weigh_ins(api, start_date, end_date,
     return weigh_ins
 
 
-def get_garmin_stats(start_date, end_date,
-                     logger=razator_utils.log.get_stout_logger('garmin_api')):
+def iter_weigh_ins(api, start_date, end_date,
+                   logger=razator_utils.log.get_stout_logger('garmin_activities')):
+    """
+    Get the weigh-ins from garmin one at a time
+
+    :param api: garmin API Class (Garmin)
+    :param start_date: Start date for weigh-ins (datetime.date)
+    :param end_date: End date for weigh-ins (datetime.date)
+    :param logger: Logger object (logging.Logger)
+
+    :return: Generator of weigh-in rows (dicts)
+    """
+    logger.info('Getting weigh-ins')
+    start_date = max(start_date, dt.date(2017, 1, 13))
+    raw_weigh_ins = api.get_weigh_ins(start_date.isoformat(), end_date.isoformat())
+    weigh_ins = transform_weigh_ins(raw_weigh_ins)
+    logger.info(f'Found {len(weigh_ins)} weigh-ins')
+    yield from weigh_ins
+
+
+def replay_garmin_stats(cache, logger=razator_utils.log.get_stout_logger('garmin_replay')):
+    """
+    Rebuild the stats from every response saved in the cache without calling garmin
+
+    :param cache: Cache of raw garmin responses (ResponseCache)
+    :param logger: Logger object (logging.Logger)
+
+    :return: Generator of (model, row) tuples rebuilt from the cache (type, dict)
     """
-    Get the stats from garmin
+    replay_api = CachedGarmin(None, cache, replay=True)
+    replayed = 0
+    for endpoint, args, payload in cache.entries():
+        if endpoint == 'get_stats':
+            yield GarminStat, transform_daily_stats(dt.date.fromisoformat(args[0]), payload)
+        elif endpoint == 'get_activities_by_date':
+            flat_activities = flatten_activities(payload)
+            reclassify_activities(replay_api, flat_activities, logger=logger)
+            for flat_act in flat_activities:
+                yield Activity, flat_act
+        elif endpoint == 'get_weigh_ins':
+            for weigh_in in transform_weigh_ins(payload):
+                yield WeighIn, weigh_in
+        replayed += 1
+    logger.info(f'Replayed {replayed} responses from the cache')
+
+
+def login_garmin(tokenstore='~/.garminconnect', email=None, password=None):
+    """
+    Log in to garmin connect
+
+    :param tokenstore: Folder holding the saved garmin tokens (str)
+    :param email: Email to log in with when there are no saved tokens (str)
+    :param password: Password to log in with when there are no saved tokens (str)
 
+    :return: api: Logged in garmin API Class (Garmin)
+    """
+    # garminconnect is slow to import and only needed once we log in
+    from garminconnect import Garmin
+
+    with RUN_METRICS.timer('stage', stage='login'):
+        api = Garmin(email, password) if email else Garmin()
+        api.login(tokenstore=tokenstore)
+    return api
+
+
+def stream_garmin_stats(api, start_date, end_date,
+                        logger=razator_utils.log.get_stout_logger('garmin_api'), workers=1, activity_window='month',
+                        skip_ids=()):
+    """
+    Get the stats from garmin as a single stream of rows tagged with the model they belong to
+
+    :param api: Logged in garmin API Class (Garmin)
     :param start_date: Start date for stats (datetime.date)
     :param end_date: End date for stats (datetime.date)
     :param logger: Logger object (logging.Logger)
+    :param workers: Number of daily stats requests to run at the same time (int)
+    :param activity_window: Size of the windows activities are pulled in, see activity_windows (str or int)
+    :param skip_ids: Activities already reclassified in garmin, see reclassify_activities (set of int)
 
-    :return: daily_data, activity_data: Daily and activity data from garmin (each a list of dicts)
+    :return: Generator of (model, row) tuples (type, dict)
     """
     start_date, end_date = (end_date, start_date) if end_date < start_date else (start_date, end_date)
-    api = Garmin()
-    api.login(tokenstore='~/.garminconnect')
+    for day_data in iter_daily_stats(api, start_date, end_date, workers):
+        yield GarminStat, day_data
+    for activity in iter_garmin_activities(api, start_date, end_date, logger, activity_window, workers,
+                                           skip_ids):
+        yield Activity, activity
+    for weigh_in in iter_weigh_ins(api, start_date, end_date, logger):
+        yield WeighIn, weigh_in
 
-    daily_data = get_daily_stats(api, start_date, end_date)
-    activity_data = get_garmin_activities(api, start_date, end_date, logger)
-    weigh_ins = get_weigh_ins(api, start_date, end_date, logger)
 
-    return daily_data, activity_data, weigh_ins
+def start_profiler(logger=razator_utils.log.get_stout_logger('garmin_extract')):
+    """
+    Start a profiler for the whole run, pyinstrument's sampling profiler if it is installed
+    otherwise cProfile
 
+    :param logger: Logger object (logging.Logger)
 
-if __name__ == '__main__':
-    load_dotenv()
+    :return: profiler: The running profiler (pyinstrument.Profiler or cProfile.Profile)
+    """
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        logger.warning('pyinstrument is not installed, profiling with cProfile instead of sampling')
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    profiler = Profiler()
+    profiler.start()
+    return profiler
+
+
+def stop_profiler(profiler, output_dir):
+    """
+    Stop the profiler and save its report
+
+    :param profiler: Profiler from start_profiler (pyinstrument.Profiler or cProfile.Profile)
+    :param output_dir: Folder to save the report in (pathlib.Path)
+
+    :return: path: Where the report was saved (pathlib.Path)
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    timestamp = dt.datetime.now().strftime('%Y%m%d_%H%M%S')
+    if hasattr(profiler, 'output_html'):
+        profiler.stop()
+        path = output_dir / f'garmin_extract_profile_{timestamp}.html'
+        path.write_text(profiler.output_html())
+    else:
+        profiler.disable()
+        path = output_dir / f'garmin_extract_profile_{timestamp}.prof'
+        profiler.dump_stats(path)
+    return path
+
+
+def sync_range(api, session, start_date, end_date,
+               logger=razator_utils.log.get_stout_logger('garmin_sync'), workers=1,
+               activity_window='month', chunk_days=30, chunk_size=1000, incremental=False, intraday=False,
+               account=DEFAULT_ACCOUNT):
+    """
+    Pull a date range from garmin into the database, committing one chunk of days at a time.
+    A range that was stopped part way through picks up after the last committed chunk.
+
+    :param api: Logged in garmin API Class (Garmin)
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param start_date: Start date for stats (datetime.date)
+    :param end_date: End date for stats (datetime.date)
+    :param logger: Logger object (logging.Logger)
+    :param workers: Number of requests to run at the same time (int)
+    :param activity_window: Size of the windows activities are pulled in, see activity_windows (str or int)
+    :param chunk_days: Days to pull and commit at a time (int)
+    :param chunk_size: Max rows to send in each statement (int)
+    :param incremental: Start from the last completed day instead of start_date when there is one (bool)
+    :param intraday: Also load the intraday heart rate, stress, body battery and step series (bool)
+    :param account: Account the rows belong to (str)
+
+    :return: counts: Inserted and updated counts keyed by table name (dict of (int, int))
+    """
+    if intraday and account != DEFAULT_ACCOUNT:
+        raise ValueError('The intraday tables have no account column, only the default account can load them')
+    start_date, end_date = sorted([start_date, end_date])
+    if incremental:
+        start_date = incremental_start(session, start_date, account)
+    range_start = start_date
+    start_date = resume_start(session, range_start, end_date, account)
+    if start_date != range_start:
+        logger.info(f'Resuming sync of {range_start} to {end_date} from {start_date}')
+
+    counts = {}
+    for chunk_start, chunk_end in date_chunks(start_date, end_date, chunk_days):
+        # looked up before write_stream takes over the session
+        skip_ids = reclassified_ids(session, chunk_start, chunk_end, account=account)
+        rows = stream_garmin_stats(api, chunk_start, chunk_end, logger, workers, activity_window, skip_ids)
+        for table_name, (inserted, updated) in write_stream(session, rows, chunk_size, logger,
+                                                            account=account).items():
+            table_inserted, table_updated = counts.get(table_name, (0, 0))
+            counts[table_name] = (table_inserted + inserted, table_updated + updated)
+        if intraday:
+            for table_name, copied in load_intraday(session, api, chunk_start, chunk_end, workers, logger).items():
+                table_inserted, table_updated = counts.get(table_name, (0, 0))
+                counts[table_name] = (table_inserted + copied, table_updated)
+        with RUN_METRICS.timer('stage', stage='db_step_summary'):
+            refresh_step_summary(session, range(chunk_start.year, chunk_end.year + 1), account)
+        record_progress(session, range_start, end_date, chunk_start, chunk_end, account=account)
+        with RUN_METRICS.timer('stage', stage='db_commit'):
+            session.commit()
+        logger.info(f'Synced {chunk_start} to {chunk_end}')
+    return counts
+
+
+def add_arguments(arg_parser):
+    """
+    Add the sync options to a parser
+
+    :param arg_parser: Parser for the sync command (argparse.ArgumentParser)
+    """
+    arg_parser.add_argument('-f', '--from_date', default=dt.date.today() - dt.timedelta(days=1),  type=dt.date.fromisoformat,
+                            help='Start date (in iso 8601 format) for the stats (default yesterday)')
+    arg_parser.add_argument('-e', '--end_date', default=dt.date.today(),
+                            type=dt.date.fromisoformat,
+                            help='End date (in iso 8601 format) for the stats (default yesterday)')
+    arg_parser.add_argument('-v', '--stout-output', action='store_true', help='Export logging to terminal')
+    arg_parser.add_argument('-w', '--workers', default=1, type=int,
+                            help='Number of days or activity windows to pull from garmin at the same time '
+                                 '(default 1)')
+    arg_parser.add_argument('-r', '--rate_limit', default=None, type=float,
+                            help='Max requests per second to garmin across every endpoint (default no limit)')
+    arg_parser.add_argument('-c', '--chunk_size', default=1000, type=int,
+                            help='Rows to write to the database in each statement (default 1000)')
+    arg_parser.add_argument('-i', '--incremental', action='store_true',
+                            help='Start from the last completed day saved in the database instead of from_date')
+    arg_parser.add_argument('-d', '--chunk_days', default=30, type=int,
+                            help='Days to pull and commit at a time so a failed run can resume (default 30)')
+    arg_parser.add_argument('-a', '--activity_window', default='month',
+                            type=lambda value: value if value in ('month', 'year') else int(value),
+                            help='Window to pull activities in: month, year or a number of days (default month)')
+    arg_parser.add_argument('--intraday', action='store_true',
+                            help='Also load the intraday heart rate, stress, body battery and step series')
+    arg_parser.add_argument('--details', action='store_true',
+                            help='Download the FIT files for new activities and load their laps and records')
+    arg_parser.add_argument('--reparse', action='store_true',
+                            help='Reload the laps and records from the saved FIT files without calling garmin')
+    arg_parser.add_argument('--no_cache', action='store_true',
+                            help='Always call garmin instead of using the saved responses')
+    arg_parser.add_argument('--replay', action='store_true',
+                            help='Rebuild the database from the saved responses without calling garmin')
+    arg_parser.add_argument('-m', '--metrics_dir', default=os.getenv('GARMIN_METRICS_DIR', Path.home() / 'logs'),
+                            type=lambda value: Path(value).expanduser(),
+                            help='Folder for the run summary json and prometheus .prom file '
+                                 '(default GARMIN_METRICS_DIR or ~/logs)')
+    arg_parser.add_argument('--max_retries', default=5, type=int,
+                            help='Times to retry a failed or throttled garmin call (default 5)')
+    arg_parser.add_argument('-p', '--profile', action='store_true',
+                            help='Run under a sampling profiler and save the report in metrics_dir')
+
+
+def main(args):
+    """
+    Run the extract
+
+    :param args: Parsed command line arguments from add_arguments (argparse.Namespace)
+    """
     # noinspection PyBroadException
     try:
         if not os.getenv('GARMIN_SIGNIN_EMAIL'):
@@ -202,15 +473,6 @@ if __name__ == '__main__':
         raise
 
     try:
-        arg_parser = argparse.ArgumentParser(prog='garmin_export', description='Scrape my garmin stats')
-        arg_parser.add_argument('-f', '--from_date', default=dt.date.today() - dt.timedelta(days=1),  type=dt.date.fromisoformat,
-                                help='Start date (in iso 8601 format) for the stats (default yesterday)')
-        arg_parser.add_argument('-e', '--end_date', default=dt.date.today(),
-                                type=dt.date.fromisoformat,
-                                help='End date (in iso 8601 format) for the stats (default yesterday)')
-        arg_parser.add_argument('-v', '--stout-output', action='store_true', help='Export logging to terminal')
-        args = arg_parser.parse_args()
-
         if args.stout_output:
             file_logger = razator_utils.log.get_stout_logger('garmin_extract', 'INFO')
         else:
@@ -222,34 +484,51 @@ if __name__ == '__main__':
             razator_utils.discord_message(alert_url, 'Garmin Extract Failed. Please check arguments')
         raise
 
+    profiler = start_profiler(file_logger) if args.profile else None
     try:
         file_logger.info('Starting the extract of Garmin stats')
 
-        daily_stats, activities, weights = get_garmin_stats(
-            logger=file_logger, start_date=args.from_date, end_date=args.end_date
-        )
-
         session = init_db()
-        for day_stat in daily_stats:
-            if (day_row := session.query(GarminStat).filter_by(date=day_stat['date'])).first():
-                day_row.update(day_stat)
-            else:
-                session.add(GarminStat(**day_stat))
-        for activity in activities:
-            if (activity_row := session.query(Activity).filter_by(activity_id=activity['activity_id'])).first():
-                activity_row.update(activity)
-            else:
-                session.add(Activity(**activity))
-        for weight in weights:
-            if (weight_row := session.query(WeighIn).filter_by(weigh_in_id=str(weight['weigh_in_id']))).first():
-                weight_row.update(weight)
-            else:
-                session.add(WeighIn(**weight))
-        session.commit()
+        cache = ResponseCache(os.getenv('GARMIN_CACHE_DIR'),
+                              max_bytes=int(os.getenv('GARMIN_CACHE_MAX_MB', '1024')) * 1024 ** 2,
+                              logger=file_logger)
+        fit_store = FitStore(os.getenv('GARMIN_FIT_DIR'))
+        if args.reparse:
+            file_logger.info(f'Reparsed {reparse_store(session, fit_store, file_logger)} FIT files')
+        elif args.replay:
+            write_stream(session, replay_garmin_stats(cache, file_logger), args.chunk_size, file_logger)
+            if args.intraday:
+                replay_intraday(session, cache, file_logger)
+            refresh_step_summary(session)
+            session.commit()
+        else:
+            api = GarminClient(InstrumentedGarmin(login_garmin()), max_retries=args.max_retries,
+                               max_concurrency=args.workers, rate_limit=args.rate_limit, logger=file_logger)
+            if not args.no_cache:
+                api = CachedGarmin(api, cache)
+            sync_range(api, session, args.from_date, args.end_date, file_logger, args.workers,
+                       args.activity_window, args.chunk_days, args.chunk_size, args.incremental, args.intraday)
+            if args.details:
+                sync_activity_details(session, api, fit_store, args.workers, file_logger)
+            if not args.no_cache:
+                file_logger.info(f'Cache hits: {api.hits}, misses: {api.misses}')
         session.close()
     except Exception:
         file_logger.exception('Garmin extract failed')
+        RUN_METRICS.increment('failed_runs')
         if alert_url := os.getenv('DISCORD_ALERT_URL'):
             razator_utils.discord_message(alert_url, 'Garmin Extract Failed. Check logs for details.')
         sys.exit(1)
+    finally:
+        if profiler:
+            file_logger.info(f'Saved profile to {stop_profiler(profiler, args.metrics_dir)}')
+        RUN_METRICS.write_json(args.metrics_dir / 'garmin_extract_metrics.json')
+        RUN_METRICS.write_prometheus(args.metrics_dir / 'garmin_extract.prom')
     file_logger.info('Finished extract')
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    main_parser = argparse.ArgumentParser(prog='garmin_export', description='Scrape my garmin stats')
+    add_arguments(main_parser)
+    main(main_parser.parse_args())
@@ -0,0 +1,148 @@
+import csv
+import datetime as dt
+import io
+
+import razator_utils
+from sqlalchemy import insert
+
+from metrics import RUN_METRICS, timed
+from model import BodyBatterySample, HeartRateSample, StepSample, StressSample
+from parallel import ordered_map
+
+INTRADAY_MODELS = (HeartRateSample, StressSample, BodyBatterySample, StepSample)
+
+
+def _from_millis(millis):
+    return dt.datetime.fromtimestamp(millis / 1000, dt.timezone.utc)
+
+
+def _from_gmt_string(value):
+    return dt.datetime.fromisoformat(value[:19]).replace(tzinfo=dt.timezone.utc)
+
+
+@timed('transform_intraday')
+def transform_intraday(heart_rates, stress, steps):
+    """
+    Turn the raw intraday responses for a day into rows for each intraday table
+
+    :param heart_rates: Raw response from api.get_heart_rates (dict)
+    :param stress: Raw response from api.get_stress_data (dict)
+    :param steps: Raw response from api.get_steps_data (list of dicts)
+
+    :return: rows: Rows as tuples in column order keyed by model (dict of lists)
+    """
+    heart_rates, stress = heart_rates or {}, stress or {}
+    # garmin uses negative stress values and None for times it couldn't measure
+    return {
+        HeartRateSample: [(_from_millis(millis), bpm) for millis, bpm in heart_rates.get('heartRateValues') or []
+                          if bpm is not None],
+        StressSample: [(_from_millis(millis), level) for millis, level in stress.get('stressValuesArray') or []
+                       if level is not None and level >= 0],
+        BodyBatterySample: [(_from_millis(values[0]), values[2])
+                            for values in stress.get('bodyBatteryValuesArray') or []
+                            if len(values) > 2 and values[2] is not None],
+        StepSample: [(_from_gmt_string(step['startGMT']), step['steps'], step.get('primaryActivityLevel'))
+                     for step in steps or [] if step.get('steps') is not None],
+    }
+
+
+def copy_rows(session, model, rows):
+    """
+    Replace the rows in the time span covered by rows with them using postgres COPY, or one
+    executemany insert on other databases
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param model: Intraday model the rows are for (HeartRateSample, StressSample, ...)
+    :param rows: Rows as tuples in column order (list of tuples)
+
+    :return: Number of rows loaded (int)
+    """
+    if not rows:
+        return 0
+    table = model.__table__
+    columns = table.columns.keys()
+    rows.sort(key=lambda row: row[0])
+    session.execute(table.delete().where(table.c.timestamp.between(rows[0][0], rows[-1][0])))
+
+    if session.get_bind().dialect.name != 'postgresql':
+        with RUN_METRICS.timer('db_write', table=table.name):
+            session.execute(insert(table), [dict(zip(columns, row)) for row in rows])
+        RUN_METRICS.increment('rows_written', len(rows), table=table.name, action='inserted')
+        return len(rows)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row[0].isoformat() if i == 0 else value for i, value in enumerate(row))
+    buffer.seek(0)
+
+    with RUN_METRICS.timer('db_write', table=table.name):
+        cursor = session.connection().connection.cursor()
+        cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+        cursor.close()
+    RUN_METRICS.increment('rows_written', len(rows), table=table.name, action='copied')
+    return len(rows)
+
+
+def fetch_intraday_day(api, day):
+    """
+    Pull the intraday data for a day
+
+    :param api: garmin API Class (Garmin)
+    :param day: Day to pull (datetime.date)
+
+    :return: rows: Rows as tuples in column order keyed by model (dict of lists)
+    """
+    cdate = day.isoformat()
+    return transform_intraday(api.get_heart_rates(cdate), api.get_stress_data(cdate), api.get_steps_data(cdate))
+
+
+def load_intraday(session, api, start_date, end_date, workers=1,
+                  logger=razator_utils.log.get_stout_logger('garmin_intraday')):
+    """
+    Pull the intraday heart rate, stress, body battery and step series for a date range and
+    COPY them into their tables. Days are pulled several at a time and loaded in batches of a week.
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param api: garmin API Class (Garmin)
+    :param start_date: First day to pull (datetime.date)
+    :param end_date: Last day to pull (datetime.date)
+    :param workers: Number of days to pull at the same time (int)
+    :param logger: Logger object (logging.Logger)
+
+    :return: counts: Rows loaded keyed by table name (dict of int)
+    """
+    start_date = max(start_date, dt.date(2017, 9, 5))
+    days = [start_date + dt.timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    counts = {model.__tablename__: 0 for model in INTRADAY_MODELS}
+    batch = {model: [] for model in INTRADAY_MODELS}
+    for i, day_rows in enumerate(ordered_map(lambda day: fetch_intraday_day(api, day), days, workers), 1):
+        for model, rows in day_rows.items():
+            batch[model] += rows
+        if i % 7 == 0 or i == len(days):
+            for model, rows in batch.items():
+                counts[model.__tablename__] += copy_rows(session, model, rows)
+            batch = {model: [] for model in INTRADAY_MODELS}
+    logger.info('Loaded intraday ' + ', '.join(f'{table}: {count}' for table, count in counts.items()))
+    return counts
+
+
+def replay_intraday(session, cache, logger=razator_utils.log.get_stout_logger('garmin_intraday')):
+    """
+    Reload the intraday tables from the responses saved in the cache without calling garmin
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param cache: Cache of raw garmin responses (ResponseCache)
+    :param logger: Logger object (logging.Logger)
+
+    :return: counts: Rows loaded keyed by table name (dict of int)
+    """
+    counts = {model.__tablename__: 0 for model in INTRADAY_MODELS}
+    for endpoint, position in (('get_heart_rates', 0), ('get_stress_data', 1), ('get_steps_data', 2)):
+        for _, _, payload in cache.entries(endpoint):
+            responses = [None, None, None]
+            responses[position] = payload
+            for model, rows in transform_intraday(*responses).items():
+                counts[model.__tablename__] += copy_rows(session, model, rows)
+    logger.info('Replayed intraday ' + ', '.join(f'{table}: {count}' for table, count in counts.items()))
+    return counts
@@ -0,0 +1,185 @@
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class RunMetrics:
+    """
+    Thread safe latency histograms and counters for one run of the extract
+    """
+
+    def __init__(self, prefix='garmin_export'):
+        """
+        :param prefix: Prefix for the metric names in the prometheus output (str)
+        """
+        self.prefix = prefix
+        self.started = time.time()
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, seconds, **labels):
+        """
+        Add a timing to a histogram
+
+        :param name: Histogram name (str)
+        :param seconds: Time taken (float)
+        :param labels: Labels for the histogram (str)
+        """
+        with self._lock:
+            histogram = self._histograms.setdefault(self._key(name, labels),
+                                                    {'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'sum': 0.0})
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    def increment(self, name, value=1, **labels):
+        """
+        Add to a counter
+
+        :param name: Counter name (str)
+        :param value: Amount to add (int)
+        :param labels: Labels for the counter (str)
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Time the body of a with block into a histogram
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def summary(self):
+        """
+        :return: summary: Everything recorded so far (dict)
+        """
+        with self._lock:
+            histograms = [{'name': name, 'labels': dict(labels), 'count': histogram['count'],
+                           'sum': round(histogram['sum'], 6),
+                           'buckets': dict(zip(map(str, LATENCY_BUCKETS), histogram['buckets']))}
+                          for (name, labels), histogram in sorted(self._histograms.items())]
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+        return {'started': self.started, 'duration': round(time.time() - self.started, 3),
+                'histograms': histograms, 'counters': counters}
+
+    def write_json(self, path):
+        """
+        Save the run summary as json
+
+        :param path: File to write (str or pathlib.Path)
+        """
+        write_text_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path):
+        """
+        Save the metrics in the prometheus text format for the node exporter textfile collector
+
+        :param path: File to write, should end in .prom (str or pathlib.Path)
+        """
+        def label_text(labels, **extra):
+            labels = {**labels, **extra}
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}' if labels else ''
+
+        summary = self.summary()
+        lines = []
+        for name in sorted({histogram['name'] for histogram in summary['histograms']}):
+            lines.append(f'# TYPE {self.prefix}_{name}_seconds histogram')
+            for histogram in (h for h in summary['histograms'] if h['name'] == name):
+                for bound, count in histogram['buckets'].items():
+                    lines.append(f'{self.prefix}_{name}_seconds_bucket'
+                                 f'{label_text(histogram["labels"], le=bound)} {count}')
+                lines.append(f'{self.prefix}_{name}_seconds_bucket{label_text(histogram["labels"], le="+Inf")} '
+                             f'{histogram["count"]}')
+                lines.append(f'{self.prefix}_{name}_seconds_sum{label_text(histogram["labels"])} {histogram["sum"]}')
+                lines.append(f'{self.prefix}_{name}_seconds_count{label_text(histogram["labels"])} '
+                             f'{histogram["count"]}')
+        for name in sorted({counter['name'] for counter in summary['counters']}):
+            lines.append(f'# TYPE {self.prefix}_{name}_total counter')
+            for counter in (c for c in summary['counters'] if c['name'] == name):
+                lines.append(f'{self.prefix}_{name}_total{label_text(counter["labels"])} {counter["value"]}')
+        lines.append(f'# TYPE {self.prefix}_last_run_timestamp_seconds gauge')
+        lines.append(f'{self.prefix}_last_run_timestamp_seconds {summary["started"]}')
+        lines.append(f'# TYPE {self.prefix}_last_run_duration_seconds gauge')
+        lines.append(f'{self.prefix}_last_run_duration_seconds {summary["duration"]}')
+        write_text_atomic(path, '\n'.join(lines) + '\n')
+
+
+def write_text_atomic(path, text):
+    # the textfile collector can read the file at any time so never leave it half written
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(fd, 'w') as tmp_file:
+        tmp_file.write(text)
+    os.replace(tmp_path, path)
+
+
+RUN_METRICS = RunMetrics()
+
+
+def timed(stage):
+    """
+    Decorator that times every call of a function into the stage histogram
+
+    :param stage: Name of the stage (str)
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with RUN_METRICS.timer('stage', stage=stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class InstrumentedGarmin:
+    """
+    Wraps the Garmin API class to time and count every call made through it
+    """
+
+    def __init__(self, api, metrics=RUN_METRICS):
+        """
+        :param api: garmin API Class (Garmin)
+        :param metrics: Where to record the calls (RunMetrics)
+        """
+        self.api = api
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                result = attr(*args, **kwargs)
+                status = 'ok'
+                return result
+            finally:
+                self.metrics.observe('api_call', time.perf_counter() - started, endpoint=name)
+                self.metrics.increment('api_calls', endpoint=name, status=status)
+        return call
@@ -0,0 +1,167 @@
+import datetime as dt
+import os
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+
+MIGRATIONS = []
+migration_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', migration_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def migration(version, description, enabled=None):
+    """
+    Decorator that registers a function as a schema migration. The function gets the
+    connection and the models metadata and runs inside the same transaction that records it.
+
+    :param version: Unique version, migrations run in this order (int)
+    :param description: What the migration does (str)
+    :param enabled: Function returning if the migration should run yet, it is left pending if not (callable)
+    """
+    def decorator(func):
+        MIGRATIONS.append((version, description, enabled, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+def partition_by_year():
+    return os.getenv('GARMIN_PARTITION_BY_YEAR', '').lower() in ('1', 'true', 'yes')
+
+
+@migration(1, 'create tables')
+def create_tables(connection, metadata):
+    metadata.create_all(connection)
+
+
+@migration(2, 'activity type and date indexes')
+def activity_indexes(connection, metadata):
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_activities_type_date '
+                            'ON activities (activity_type_type_id, (date(start_time_local)))'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_activities_date ON activities ((date(start_time_local)))'))
+
+
+@migration(3, 'weigh-in date index')
+def weigh_in_indexes(connection, metadata):
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_weigh_ins_calendar_date ON weigh_ins (calendar_date)'))
+
+
+def ensure_year_partitions(connection, table_name, first_year, last_year):
+    """
+    Create the yearly partitions of a table that don't exist yet
+
+    :param connection: Database connection (sqlalchemy.engine.Connection)
+    :param table_name: Partitioned table (str)
+    :param first_year: First year to create (int)
+    :param last_year: Last year to create (int)
+    """
+    for year in range(first_year, last_year + 1):
+        connection.execute(text(f'CREATE TABLE IF NOT EXISTS {table_name}_{year} PARTITION OF {table_name} '
+                                f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"))
+
+
+@migration(4, 'partition daily_stats by year', enabled=partition_by_year)
+def partition_daily_stats(connection, metadata):
+    # activities can't be partitioned by start time without adding it to the primary key,
+    # which would break the ON CONFLICT (activity_id) upsert, so only daily_stats is split up
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text('ALTER TABLE daily_stats RENAME TO daily_stats_unpartitioned'))
+    connection.execute(text('ALTER INDEX daily_stats_pkey RENAME TO daily_stats_unpartitioned_pkey'))
+    connection.execute(text('CREATE TABLE daily_stats (LIKE daily_stats_unpartitioned INCLUDING DEFAULTS) '
+                            'PARTITION BY RANGE (date)'))
+    # a database from before migration 6 doesn't have the account column yet, that
+    # migration adds it to the key of the partitioned table the same way
+    columns = {column['name'] for column in inspect(connection).get_columns('daily_stats_unpartitioned')}
+    key = ', '.join(column.name for column in metadata.tables['daily_stats'].primary_key.columns
+                    if column.name in columns)
+    connection.execute(text(f'ALTER TABLE daily_stats ADD PRIMARY KEY ({key})'))
+    connection.execute(text('CREATE TABLE daily_stats_default PARTITION OF daily_stats DEFAULT'))
+    first_year = connection.execute(text('SELECT min(extract(year FROM date))::int '
+                                         'FROM daily_stats_unpartitioned')).scalar()
+    ensure_year_partitions(connection, 'daily_stats', first_year or dt.date.today().year, dt.date.today().year + 1)
+    connection.execute(text('INSERT INTO daily_stats SELECT * FROM daily_stats_unpartitioned'))
+    connection.execute(text('DROP TABLE daily_stats_unpartitioned'))
+
+
+@migration(5, 'updated_at on the synced tables')
+def add_updated_at(connection, metadata):
+    for table_name in ('daily_stats', 'activities', 'weigh_ins'):
+        if 'updated_at' not in {column['name'] for column in inspect(connection).get_columns(table_name)}:
+            connection.execute(text(f'ALTER TABLE {table_name} ADD COLUMN updated_at TIMESTAMP'))
+
+
+ACCOUNT_TABLES = ('daily_stats', 'activities', 'weigh_ins', 'step_year_summary', 'sync_state')
+
+
+@migration(6, 'account in the primary keys')
+def add_account_keys(connection, metadata):
+    for table_name in ACCOUNT_TABLES:
+        if 'account' in {column['name'] for column in inspect(connection).get_columns(table_name)}:
+            continue
+        table = metadata.tables[table_name]
+        key = ', '.join(column.name for column in table.primary_key.columns)
+        if connection.dialect.name == 'postgresql':
+            default = table.c.account.server_default.arg
+            connection.execute(text(f'ALTER TABLE {table_name} '
+                                    f"ADD COLUMN account VARCHAR NOT NULL DEFAULT '{default}'"))
+            connection.execute(text(f'ALTER TABLE {table_name} DROP CONSTRAINT {table_name}_pkey'))
+            connection.execute(text(f'ALTER TABLE {table_name} ADD PRIMARY KEY ({key})'))
+            continue
+        # sqlite can't change a primary key so the table is copied into a new one
+        columns = ', '.join(column['name'] for column in inspect(connection).get_columns(table_name))
+        connection.execute(text(f'ALTER TABLE {table_name} RENAME TO {table_name}_old'))
+        table.create(connection)
+        connection.execute(text(f'INSERT INTO {table_name} ({columns}) SELECT {columns} FROM {table_name}_old'))
+        connection.execute(text(f'DROP TABLE {table_name}_old'))
+    activity_indexes(connection, metadata)
+    weigh_in_indexes(connection, metadata)
+
+
+@migration(7, 'first completed day on sync_state')
+def add_first_completed_date(connection, metadata):
+    if 'first_completed_date' not in {column['name'] for column in inspect(connection).get_columns('sync_state')}:
+        connection.execute(text('ALTER TABLE sync_state ADD COLUMN first_completed_date DATE'))
+
+
+def is_partitioned(connection, table_name):
+    return connection.execute(text('SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid '
+                                   'WHERE c.relname = :table_name'), {'table_name': table_name}).first() is not None
+
+
+def migrate(engine, metadata, logger=None, target=None):
+    """
+    Run the migrations that haven't been applied to a database yet, each in its own transaction
+
+    :param engine: Engine for the database (sqlalchemy.engine.Engine)
+    :param metadata: Metadata of the models (sqlalchemy.MetaData)
+    :param logger: Logger object (logging.Logger)
+    :param target: Last version to apply, all of them if not given (int)
+
+    :return: applied: Versions that were applied (list of int)
+    """
+    migration_metadata.create_all(engine)
+    with engine.connect() as connection:
+        done = set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+    applied = []
+    for version, description, enabled, func in MIGRATIONS:
+        if version in done or (enabled and not enabled()) or (target is not None and version > target):
+            continue
+        with engine.begin() as connection:
+            func(connection, metadata)
+            connection.execute(schema_migrations.insert().values(version=version, description=description,
+                                                                 applied_at=dt.datetime.now()))
+        applied.append(version)
+        if logger:
+            logger.info(f'Applied migration {version}: {description}')
+
+    if partition_by_year() and engine.dialect.name == 'postgresql':
+        with engine.begin() as connection:
+            if is_partitioned(connection, 'daily_stats'):
+                ensure_year_partitions(connection, 'daily_stats', dt.date.today().year, dt.date.today().year + 1)
+    return applied
@@ -1,11 +1,20 @@
+import datetime as dt
 import os
+from pathlib import Path
 
-from sqlalchemy import BIGINT, Column, Integer, String, create_engine, Date, DateTime, Boolean, Float
+from sqlalchemy import BIGINT, Column, Integer, SmallInteger, String, create_engine, Date, DateTime, Boolean, Float, \
+    Index, event
+from sqlalchemy.engine import URL, make_url
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from migrations import migrate
+
 Base = declarative_base()
 
+# rows synced without an accounts config belong to this account
+DEFAULT_ACCOUNT = 'default'
+
 
 def convert_speed_to_pace(speed):
     pace = 1 / (speed * 0.00062137)  # get pace in seconds per mile
@@ -16,6 +25,7 @@ def convert_speed_to_pace(speed):
 
 class GarminStat(Base):
     __tablename__ = 'daily_stats'
+    account = Column(String, primary_key=True, server_default=DEFAULT_ACCOUNT)
     date = Column(Date, primary_key=True)
     day_of_week = Column(String(9), nullable=False)
     wellness_active_calories = Column(Integer, nullable=False)
@@ -45,10 +55,13 @@ class GarminStat(Base):
     wellness_bodybattery_charged = Column(Integer, nullable=False)
     wellness_bodybattery_drained = Column(Integer, nullable=False)
     wellness_abnormalhr_alerts_count = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=True, default=dt.datetime.now, onupdate=dt.datetime.now)
+    __partition_column__ = 'date'
 
 
 class Activity(Base):
     __tablename__ = 'activities'
+    account = Column(String, primary_key=True, server_default=DEFAULT_ACCOUNT)
     activity_id = Column(BIGINT, primary_key=True)
     activity_name = Column(String, nullable=False)
     start_time_local = Column(DateTime, nullable=False)
@@ -91,6 +104,8 @@ class Activity(Base):
     manual_activity = Column(Boolean, nullable=False)
     auto_calc_calories = Column(Boolean, nullable=False)
     elevation_corrected = Column(String, nullable=True)
+    updated_at = Column(DateTime, nullable=True, default=dt.datetime.now, onupdate=dt.datetime.now)
+    __partition_column__ = 'start_time_local'
 
     @property
     def duration_minutes(self):
@@ -115,18 +130,174 @@ class Activity(Base):
 
 class WeighIn(Base):
     __tablename__ = 'weigh_ins'
+    account = Column(String, primary_key=True, server_default=DEFAULT_ACCOUNT)
     weigh_in_id = Column(String, primary_key=True)
     weight_timestamp_utc = Column(DateTime, nullable=False)
     weight_timestamp_mountain = Column(DateTime, nullable=False)
     calendar_date = Column(Date, nullable=False)
     weight_kg = Column(Float, nullable=False)
     weight_lbs = Column(Float, nullable=False)
+    updated_at = Column(DateTime, nullable=True, default=dt.datetime.now, onupdate=dt.datetime.now)
+    __partition_column__ = 'calendar_date'
+
+
+class StepYearSummary(Base):
+    __tablename__ = 'step_year_summary'
+    account = Column(String, primary_key=True, server_default=DEFAULT_ACCOUNT)
+    year = Column(Integer, primary_key=True)
+    days = Column(Integer, nullable=False)
+    goal_met_days = Column(Integer, nullable=False)
+    total_steps = Column(BIGINT, nullable=False)
+    first_date = Column(Date, nullable=False)
+    last_date = Column(Date, nullable=False)
+
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    account = Column(String, primary_key=True, server_default=DEFAULT_ACCOUNT)
+    data_type = Column(String, primary_key=True)
+    # every day from first_completed_date to last_completed_date has been pulled, rows from
+    # before first_completed_date was added have no start and cover everything before
+    first_completed_date = Column(Date, nullable=True)
+    last_completed_date = Column(Date, nullable=True)
+    checkpoint_start = Column(Date, nullable=True)
+    checkpoint_date = Column(Date, nullable=True)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class ActivityLap(Base):
+    __tablename__ = 'activity_laps'
+    activity_id = Column(BIGINT, primary_key=True)
+    lap_index = Column(Integer, primary_key=True)
+    start_time = Column(DateTime(timezone=True), nullable=True)
+    total_elapsed_time = Column(Float, nullable=True)
+    total_timer_time = Column(Float, nullable=True)
+    total_distance = Column(Float, nullable=True)
+    avg_speed = Column(Float, nullable=True)
+    max_speed = Column(Float, nullable=True)
+    avg_heart_rate = Column(SmallInteger, nullable=True)
+    max_heart_rate = Column(SmallInteger, nullable=True)
+    avg_cadence = Column(SmallInteger, nullable=True)
+    total_calories = Column(Integer, nullable=True)
+    total_ascent = Column(Integer, nullable=True)
+    total_descent = Column(Integer, nullable=True)
+    __partition_column__ = 'start_time'
+
+
+class ActivityRecord(Base):
+    __tablename__ = 'activity_records'
+    activity_id = Column(BIGINT, primary_key=True)
+    timestamp = Column(DateTime(timezone=True), primary_key=True)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+    distance = Column(Float, nullable=True)
+    speed = Column(Float, nullable=True)
+    altitude = Column(Float, nullable=True)
+    heart_rate = Column(SmallInteger, nullable=True)
+    cadence = Column(SmallInteger, nullable=True)
+    __partition_column__ = 'timestamp'
+
+
+# The intraday tables get millions of rows so they have no primary key index, just a BRIN
+# index on the timestamp which stays tiny because rows are loaded in time order
+class HeartRateSample(Base):
+    __tablename__ = 'heart_rate_samples'
+    timestamp = Column(DateTime(timezone=True), nullable=False)
+    heart_rate = Column(SmallInteger, nullable=False)
+    __table_args__ = (Index('ix_heart_rate_samples_timestamp', 'timestamp', postgresql_using='brin'),)
+    __mapper_args__ = {'primary_key': [timestamp]}
+    __partition_column__ = 'timestamp'
+
+
+class StressSample(Base):
+    __tablename__ = 'stress_samples'
+    timestamp = Column(DateTime(timezone=True), nullable=False)
+    stress_level = Column(SmallInteger, nullable=False)
+    __table_args__ = (Index('ix_stress_samples_timestamp', 'timestamp', postgresql_using='brin'),)
+    __mapper_args__ = {'primary_key': [timestamp]}
+    __partition_column__ = 'timestamp'
+
+
+class BodyBatterySample(Base):
+    __tablename__ = 'body_battery_samples'
+    timestamp = Column(DateTime(timezone=True), nullable=False)
+    level = Column(SmallInteger, nullable=False)
+    __table_args__ = (Index('ix_body_battery_samples_timestamp', 'timestamp', postgresql_using='brin'),)
+    __mapper_args__ = {'primary_key': [timestamp]}
+    __partition_column__ = 'timestamp'
+
+
+class StepSample(Base):
+    __tablename__ = 'step_samples'
+    timestamp = Column(DateTime(timezone=True), nullable=False)
+    steps = Column(SmallInteger, nullable=False)
+    activity_level = Column(String(16), nullable=True)
+    __table_args__ = (Index('ix_step_samples_timestamp', 'timestamp', postgresql_using='brin'),)
+    __mapper_args__ = {'primary_key': [timestamp]}
+    __partition_column__ = 'timestamp'
+
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -256 * 1024,  # negative is KiB, so 256MB of page cache
+    'mmap_size': 1024 ** 3,
+    'temp_store': 'MEMORY',
+}
+
+
+def database_url():
+    """
+    Work out the database from the environment. GARMIN_DATABASE_URL wins, then an embedded
+    SQLite file at GARMIN_DATABASE_PATH, then the postgres DATABASE_* variables.
+
+    :return: url: Database url (sqlalchemy.engine.URL)
+    """
+    if url := os.getenv('GARMIN_DATABASE_URL'):
+        return make_url(url)
+    if path := os.getenv('GARMIN_DATABASE_PATH'):
+        return URL.create('sqlite', database=str(Path(path).expanduser()))
+    return URL.create('postgresql+psycopg2', username=os.environ['DATABASE_USER'],
+                      password=os.environ['DATABASE_PASSWORD'], host=os.environ['DATABASE_HOST'],
+                      database=os.environ['DATABASE_DB'])
+
+
+def set_sqlite_pragmas(dbapi_connection, _):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {pragma} = {value}')
+    cursor.close()
+
+
+def create_db_engine(url=None):
+    """
+    Make an engine tuned for the backend, a connection pool for postgres and WAL with a
+    large page cache for SQLite
+
+    :param url: Database url, from the environment if not given (str or sqlalchemy.engine.URL)
+
+    :return: engine: Database engine (sqlalchemy.engine.Engine)
+    """
+    url = make_url(url) if url else database_url()
+    if url.get_backend_name() == 'sqlite':
+        # write_stream hands the session to its writer thread so the connection has to be allowed to move
+        engine = create_engine(url, connect_args={'check_same_thread': False})
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+        return engine
+    return create_engine(url, pool_size=int(os.getenv('GARMIN_DATABASE_POOL_SIZE', '5')), max_overflow=5,
+                         pool_pre_ping=True, pool_recycle=1800)
+
+
+def init_db(url=None):
+    """
+    Connect to the database and bring its schema up to date
 
+    :param url: Database url, from the environment if not given (str or sqlalchemy.engine.URL)
 
-def init_db():
-    engine = create_engine(f'postgresql+psycopg2://{os.environ["DATABASE_USER"]}:{os.environ["DATABASE_PASSWORD"]}'
-                           f'@{os.environ["DATABASE_HOST"]}/{os.environ["DATABASE_DB"]}')
-    Base.metadata.create_all(engine)
+    :return: Database session (sqlalchemy.orm.Session)
+    """
+    engine = create_db_engine(url)
+    migrate(engine, Base.metadata)
 
     db_session = sessionmaker(bind=engine)
     return db_session()
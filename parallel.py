@@ -0,0 +1,27 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def ordered_map(func, items, workers=1):
+    """
+    Lazily map func over items on a thread pool, yielding results in the same order as items.
+    At most workers * 2 calls are in flight so results never pile up in memory.
+
+    :param func: Function to call on each item (callable)
+    :param items: Items to pass to func (iterable)
+    :param workers: Number of threads to use, runs in the calling thread if 1 (int)
+
+    :return: Generator of func(item) results
+    """
+    if workers <= 1:
+        yield from map(func, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
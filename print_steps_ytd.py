@@ -1,67 +1,68 @@
 #!/usr/bin/env pipenv-shebang
 import argparse
 import datetime as dt
-import os
 
+import numpy as np
 from dotenv import load_dotenv
 
-from model import init_db, GarminStat
+from analytics import goal_streaks, load_arrays, rolling_mean, year_pace
+from model import DEFAULT_ACCOUNT, init_db
+from step_summary import get_step_totals
 
 
-def get_garmin_stats(db):
-    data = []
-    for row in db.query(GarminStat).all():
-        row_dict = {'date': row.date, 'total_steps': row.total_steps, 'step_goal': row.step_goal,
-                    'met_step_goal': (row.total_steps >= row.step_goal) and (row.step_goal != 0)}
-        data.append(row_dict)
-    return data
+def print_ytd(totals, arrays=None):
+    end_date = totals['end_date']
+    ytd_days, ytd_met, ytd_steps = totals['ytd']
+    prior_days, prior_met, prior_steps = totals['prior']
+    total_days, total_met, total_steps = totals['lifetime']
+    # the first year of data has no year start, max keeps an empty period at 0
+    print(f'{ytd_met:,} of {ytd_days:,} ({ytd_met / max(ytd_days, 1) * 100:.2f}%) this year')
+    print(f'{total_met:,} of {total_days:,} ({total_met / max(total_days, 1) * 100:.2f}%) total lifetime')
+    print(f'{prior_met:,} of {prior_days:,} ({prior_met / max(prior_days, 1) * 100:.2f}%) year start\n')
 
+    print(f'{ytd_steps:,} steps this year ({ytd_steps / max(ytd_days, 1):,.0f} / day avg)')
+    print(f'{total_steps:,} steps total ({total_steps / max(total_days, 1):,.0f} / day avg)')
+    print(f'{prior_steps:,} year start ({prior_steps / max(prior_days, 1):,.0f} / day avg)\n')
+    print(f'Data through {end_date.isoformat()}')
 
-def print_ytd(data, end_date=None):
-    end_date = dt.date.fromisoformat(end_date) if end_date else dt.date.today() - dt.timedelta(days=1)
-    end_date = min(end_date, max([x['date'] for x in data]))
-    data = [x for x in data if x['date'] <= end_date]
+    pace = year_pace(totals)
+    print(f'\nPace for year\'s goal is {pace["goal_pace"]:,.0f} ({"" if pace["difference"] < 0 else "+"}'
+          f'{pace["difference"]:,.0f})')
+    if pace['per_day'] is not None:
+        print(f'Need {pace["remaining"]:,} more steps this year (avg of {pace["per_day"]:,} per day)')
 
-    goal_dict = {True: len([x for x in data if x['met_step_goal']]),
-                 False: len([x for x in data if not x['met_step_goal']])}
-    total_steps = int(sum([x['total_steps'] for x in data]))
+    if arrays is not None:
+        streaks = goal_streaks(arrays, end_date)
+        print(f'\nCurrent goal streak {streaks["current"]:,} days (longest {streaks["longest"]:,} days'
+              + (f' ending {streaks["longest_end"].isoformat()})' if streaks['longest_end'] else ')'))
+        averages = []
+        for window in (7, 30):
+            days, means = rolling_mean(arrays.dates, arrays.steps, window)
+            averages.append(f'{means[np.searchsorted(days, np.datetime64(end_date, "D"))]:,.0f}')
+        print(f'{averages[0]} steps / day over the last 7 days, {averages[1]} over the last 30')
 
-    current_data = [x for x in data if dt.date(end_date.year, 1, 1) <= x['date']]
-    ytd_dict = {True: len([x for x in current_data if x['met_step_goal']]),
-                False: len([x for x in current_data if not x['met_step_goal']])}
-    ytd_steps = int(sum([x['total_steps'] for x in current_data]))
-    
-    print(f'{ytd_dict.get(True, 0):,} of {ytd_dict.get(True, 0) + ytd_dict.get(False, 0):,} '
-          f'({ytd_dict.get(True, 0) / (ytd_dict.get(True, 0) + ytd_dict.get(False, 0)) * 100:.2f}%) this year')
-    print(f'{goal_dict.get(True, 0):,} of {goal_dict.get(True, 0) + goal_dict.get(False, 0):,} '
-          f'({goal_dict.get(True, 0) / (goal_dict.get(True, 0) + goal_dict.get(False, 0)) * 100:.2f}%) total lifetime')
-    print(f'{goal_dict.get(True, 0) - ytd_dict.get(True, 0):,} of {len(data) - len(current_data):,} '
-          f'({(goal_dict.get(True, 0) - ytd_dict.get(True, 0)) / (len(data) - len(current_data)) * 100:.2f}%) '
-          f'year start\n')
-    
-    print(f'{ytd_steps:,} steps this year ({ytd_steps / len(current_data):,.0f} / day avg)')
-    print(f'{total_steps:,} steps total ({total_steps / len(data):,.0f} / day avg)')
-    print(f'{total_steps - ytd_steps:,} year start '
-          f'({(total_steps - ytd_steps) / (len(data) - len(current_data)):,.0f} / day avg)\n')
-    print(f'Data through {end_date.isoformat()}')
-    
-    year_goal = 5000000
-    goal_pace = (year_goal / 365)*len(current_data)
-    pace_diff = ytd_steps - goal_pace
-    print(f'\nPace for year\'s goal is {goal_pace:,.0f} ({"" if pace_diff < 0 else "+"}{pace_diff:,.0f})')
-    if len(current_data) < 365:
-        print(f'Need {year_goal - ytd_steps:,} more steps this year (avg of '
-              f'{int((year_goal - ytd_steps) / (365 - ytd_dict.get(True, 0) - ytd_dict.get(False, 0))):,} per day)')
 
+def add_arguments(arg_parser):
+    arg_parser.add_argument('-e', '--end_date', default=None, type=dt.date.fromisoformat, help='End date for the stats')
+    arg_parser.add_argument('-a', '--account', default=DEFAULT_ACCOUNT, help='Account to print the stats for')
+    arg_parser.add_argument('--duckdb', action='store_true', help='Read from the local DuckDB mirror')
 
-if __name__ == '__main__':
-    load_dotenv()
-    if not os.getenv('GARMIN_DATABASE_PATH'):
-        raise KeyError('Please make sure GARMIN_DATABASE_PATH is set in the environment variables')
-    arg_parser = argparse.ArgumentParser(prog='print_ytd_stats', description='Pretty print my step stats ytd')
-    arg_parser.add_argument('-e', '--end_date', default=None, help='End date for the stats')
-    args = arg_parser.parse_args()
 
-    session = init_db(os.getenv('GARMIN_DATABASE_PATH'))
-    print_ytd(get_garmin_stats(session), args.end_date)
+def main(args):
+    if args.duckdb:
+        from duckdb_mirror import open_mirror
+        session = open_mirror()
+    else:
+        session = init_db()
+    # the totals come from step_year_summary, the arrays are only needed for the streaks and averages
+    totals = get_step_totals(session, args.end_date, args.account)
+    garmin_arrays = load_arrays(session, args.account)
     session.close()
+    print_ytd(totals, garmin_arrays)
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    main_parser = argparse.ArgumentParser(prog='print_ytd_stats', description='Pretty print my step stats ytd')
+    add_arguments(main_parser)
+    main(main_parser.parse_args())
@@ -0,0 +1,38 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket used to cap how fast we call the garmin API
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: Tokens added to the bucket per second (float)
+        :param capacity: Max tokens that can build up, defaults to one second worth (float)
+        """
+        if rate <= 0:
+            raise ValueError('rate must be greater than 0')
+        self.rate = rate
+        self.capacity = capacity if capacity else max(rate, 1)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Block until there are enough tokens in the bucket then take them
+
+        :param tokens: Number of tokens to take (float)
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,170 @@
+import datetime as dt
+import re
+
+import razator_utils
+from sqlalchemy import update
+
+from model import DEFAULT_ACCOUNT, Activity
+from parallel import ordered_map
+
+
+class ReclassifyRule:
+    """
+    Moves activities of one type whose name matches a SQL LIKE pattern to another type
+    """
+
+    def __init__(self, name, type_id, name_pattern, target_type_id, target_type_key, target_parent_type_id):
+        """
+        :param name: Name of the rule for logging (str)
+        :param type_id: Activity type id the rule applies to (int)
+        :param name_pattern: SQL LIKE pattern the activity name has to match, % and _ are wildcards (str)
+        :param target_type_id: Type id to change the activity to (int)
+        :param target_type_key: Type key to change the activity to (str)
+        :param target_parent_type_id: Parent type id to change the activity to (int)
+        """
+        self.name = name
+        self.type_id = type_id
+        self.name_pattern = name_pattern
+        self.target_type_id = target_type_id
+        self.target_type_key = target_type_key
+        self.target_parent_type_id = target_parent_type_id
+        self._name_regex = re.compile(''.join('.*' if char == '%' else '.' if char == '_' else re.escape(char)
+                                              for char in name_pattern), re.DOTALL)
+
+    def matches(self, flat_act):
+        """
+        :param flat_act: Activity row (dict)
+
+        :return: If the rule should change the activity (bool)
+        """
+        return (flat_act['activity_type_type_id'] == self.type_id != self.target_type_id
+                and self._name_regex.fullmatch(flat_act['activity_name'] or '') is not None)
+
+    def db_filter(self, account=DEFAULT_ACCOUNT):
+        """
+        :param account: Account whose activities to match (str)
+
+        :return: Where clauses that match the same activities as matches (list)
+        """
+        return [Activity.account == account,
+                Activity.activity_type_type_id == self.type_id,
+                Activity.activity_type_type_id != self.target_type_id,
+                Activity.activity_name.like(self.name_pattern)]
+
+    @property
+    def target_values(self):
+        return {'activity_type_type_id': self.target_type_id,
+                'activity_type_type_key': self.target_type_key,
+                'activity_type_parent_type_id': self.target_parent_type_id}
+
+
+RULES = [
+    ReclassifyRule('frisbee_to_ultimate', type_id=11, name_pattern='%Frisbee%',
+                   target_type_id=213, target_type_key='ultimate_disc', target_parent_type_id=206),
+]
+
+
+def set_garmin_types(api, rule, activity_ids, workers=4,
+                     logger=razator_utils.log.get_stout_logger('garmin_reclassify')):
+    """
+    Change the type of activities in garmin, several at a time
+
+    :param api: garmin API Class (Garmin)
+    :param rule: Rule with the type to change to (ReclassifyRule)
+    :param activity_ids: Activities to change (list of int)
+    :param workers: Number of requests to run at the same time (int)
+    :param logger: Logger object (logging.Logger)
+
+    :return: updated_ids: Activities garmin accepted the change for (list of int)
+    """
+    def set_type(activity_id):
+        try:
+            api.set_activity_type(
+                activity_id=activity_id,
+                type_id=rule.target_type_id,
+                type_key=rule.target_type_key,
+                parent_type_id=rule.target_parent_type_id
+            )
+        except Exception:
+            logger.exception(f'Failed to update activity {activity_id} in garmin ({rule.name})')
+            return None
+        return activity_id
+
+    return [activity_id for activity_id in ordered_map(set_type, activity_ids, workers) if activity_id is not None]
+
+
+def reclassified_ids(session, start_date, end_date, rules=RULES, account=DEFAULT_ACCOUNT):
+    """
+    Find the activities already saved with one of the rules' target types, cached garmin
+    responses still have their old type so these shouldn't be sent to garmin again
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param start_date: First day of activities to check (datetime.date)
+    :param end_date: Last day of activities to check (datetime.date)
+    :param rules: Rules whose target types to look for (list of ReclassifyRule)
+    :param account: Account the activities belong to (str)
+
+    :return: activity_ids: Activities saved with a target type (set of int)
+    """
+    return {row[0] for row in session.query(Activity.activity_id).filter(
+        Activity.account == account,
+        Activity.activity_type_type_id.in_({rule.target_type_id for rule in rules}),
+        Activity.start_time_local >= dt.datetime.combine(start_date, dt.time()),
+        Activity.start_time_local < dt.datetime.combine(end_date + dt.timedelta(days=1), dt.time()))}
+
+
+def reclassify_activities(api, flat_activities, rules=RULES, workers=4,
+                          logger=razator_utils.log.get_stout_logger('garmin_reclassify'), skip_ids=()):
+    """
+    Apply the rules to freshly pulled activities, in garmin and in the rows
+
+    :param api: garmin API Class (Garmin)
+    :param flat_activities: Activity rows, updated in place (list of dicts)
+    :param rules: Rules to apply (list of ReclassifyRule)
+    :param workers: Number of garmin requests to run at the same time (int)
+    :param logger: Logger object (logging.Logger)
+    :param skip_ids: Activities already changed in garmin, only their rows are updated, see
+        reclassified_ids (set of int)
+    """
+    for rule in rules:
+        matched = {flat_act['activity_id']: flat_act for flat_act in flat_activities if rule.matches(flat_act)}
+        if not matched:
+            continue
+        for activity_id in matched.keys() & skip_ids:
+            matched.pop(activity_id).update(rule.target_values)
+        if not matched:
+            continue
+        for activity_id in set_garmin_types(api, rule, list(matched), workers, logger):
+            matched[activity_id].update(rule.target_values)
+            logger.info(f'Updated activity {activity_id} ({rule.name})')
+
+
+def reclassify_db(session, api=None, rules=RULES, workers=4,
+                  logger=razator_utils.log.get_stout_logger('garmin_reclassify'), account=DEFAULT_ACCOUNT):
+    """
+    Apply the rules to the activities already in the database with one UPDATE per rule.
+    If api is given the matching activities are changed in garmin first and only the ones
+    garmin accepted are updated.
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param api: garmin API Class, only the database is changed if not given (Garmin)
+    :param rules: Rules to apply (list of ReclassifyRule)
+    :param workers: Number of garmin requests to run at the same time (int)
+    :param logger: Logger object (logging.Logger)
+    :param account: Account to reclassify, api has to be logged in as it (str)
+
+    :return: counts: Activities updated keyed by rule name (dict of int)
+    """
+    counts = {}
+    for rule in rules:
+        stmt = update(Activity).where(*rule.db_filter(account)).values(**rule.target_values)
+        if api is not None:
+            activity_ids = [row[0] for row in session.query(Activity.activity_id).filter(*rule.db_filter(account))]
+            if not activity_ids:
+                counts[rule.name] = 0
+                continue
+            updated_ids = set_garmin_types(api, rule, activity_ids, workers, logger)
+            stmt = stmt.where(Activity.activity_id.in_(updated_ids))
+        counts[rule.name] = session.execute(stmt.execution_options(synchronize_session=False)).rowcount
+        logger.info(f'{rule.name}: updated {counts[rule.name]} activities')
+    return counts
@@ -0,0 +1,254 @@
+import datetime as dt
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+import razator_utils
+
+from sync_state import OPEN_DAYS
+
+
+def _write_atomic(path, data):
+    """
+    Write bytes to a file by way of a temp file so readers never see half a file
+
+    :param path: File to write (pathlib.Path)
+    :param data: Data to write (bytes)
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as tmp_file:
+        tmp_file.write(data)
+    os.replace(tmp_path, path)
+
+
+class ResponseCache:
+    """
+    Compressed on-disk cache of raw garmin API responses.
+
+    Responses are stored once under the sha256 of their content in objects/ and each
+    request (endpoint plus its date arguments) points at one of them from keys/. A
+    response for days that were already closed when it was pulled never expires. Anything
+    that covers the open days (see sync_state.OPEN_DAYS) is only good for open_ttl seconds.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=1024 ** 3, open_ttl=0, open_days=OPEN_DAYS,
+                 logger=razator_utils.log.get_stout_logger('garmin_cache')):
+        """
+        :param cache_dir: Folder for the cache, defaults to ~/.cache/garmin_export (str or pathlib.Path)
+        :param max_bytes: Size of stored responses before the least recently used are evicted (int)
+        :param open_ttl: Seconds a response covering an open day stays fresh (float)
+        :param open_days: Days before the day a response was pulled that garmin can still change (int)
+        :param logger: Logger object (logging.Logger)
+        """
+        self.cache_dir = Path(cache_dir).expanduser() if cache_dir else Path.home() / '.cache' / 'garmin_export'
+        self.max_bytes = max_bytes
+        self.open_ttl = open_ttl
+        self.open_days = open_days
+        self.logger = logger
+        self._keys_dir = self.cache_dir / 'keys'
+        self._objects_dir = self.cache_dir / 'objects'
+        self._size = None
+        # ordered_map workers put responses at the same time
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _request_key(endpoint, args):
+        return hashlib.sha256(json.dumps([endpoint, list(args)]).encode()).hexdigest()
+
+    def _object_path(self, content_hash):
+        return self._objects_dir / content_hash[:2] / f'{content_hash}.json.gz'
+
+    def _is_fresh(self, entry):
+        fetched_at = dt.datetime.fromisoformat(entry['fetched_at'])
+        last_day = max(dt.date.fromisoformat(arg[:10]) for arg in entry['args'])
+        if last_day < fetched_at.date() - dt.timedelta(days=self.open_days):
+            return True
+        return (dt.datetime.now() - fetched_at).total_seconds() < self.open_ttl
+
+    def get(self, endpoint, *args):
+        """
+        Get a cached response
+
+        :param endpoint: Name of the API method (str)
+        :param args: Date arguments the method was called with (str)
+
+        :return: payload: The cached response, None if it isn't cached or has expired
+        """
+        key_path = self._keys_dir / f'{self._request_key(endpoint, args)}.json'
+        try:
+            entry = json.loads(key_path.read_text())
+            if not self._is_fresh(entry):
+                return None
+            with gzip.open(self._object_path(entry['object'])) as object_file:
+                payload = json.load(object_file)
+            # mtime of the key is used as the last access time for eviction
+            os.utime(key_path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return payload
+
+    def put(self, endpoint, args, payload):
+        """
+        Save a response to the cache
+
+        :param endpoint: Name of the API method (str)
+        :param args: Date arguments the method was called with (list of str)
+        :param payload: Response from the API (json serializable)
+        """
+        body = json.dumps(payload, sort_keys=True).encode()
+        content_hash = hashlib.sha256(body).hexdigest()
+        object_path = self._object_path(content_hash)
+        entry = {'endpoint': endpoint, 'args': list(args), 'object': content_hash,
+                 'fetched_at': dt.datetime.now().isoformat()}
+        with self._lock:
+            if not object_path.exists():
+                compressed = gzip.compress(body)
+                _write_atomic(object_path, compressed)
+                if self._size is not None:
+                    self._size += len(compressed)
+            _write_atomic(self._keys_dir / f'{self._request_key(endpoint, args)}.json', json.dumps(entry).encode())
+            if self._size is None:
+                self._size = self.size()
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def size(self):
+        """
+        :return: Bytes used by the stored responses (int)
+        """
+        size = 0
+        for path in self._objects_dir.glob('*/*.json.gz'):
+            try:
+                size += path.stat().st_size
+            except FileNotFoundError:
+                continue
+        return size
+
+    def _key_entries(self):
+        for key_path in self._keys_dir.glob('*.json'):
+            try:
+                yield key_path, json.loads(key_path.read_text())
+            except (FileNotFoundError, ValueError):
+                continue
+
+    @staticmethod
+    def _last_access(key):
+        # another process can evict a key while the list is sorted
+        try:
+            return key[0].stat().st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def evict(self):
+        """
+        Drop the least recently used requests until the stored responses fit in max_bytes
+        """
+        with self._lock:
+            keys = sorted(self._key_entries(), key=self._last_access)
+            references = {}
+            for _, entry in keys:
+                references[entry['object']] = references.get(entry['object'], 0) + 1
+            size = self.size()
+            evicted = 0
+            for key_path, entry in keys:
+                if size <= self.max_bytes:
+                    break
+                key_path.unlink(missing_ok=True)
+                evicted += 1
+                references[entry['object']] -= 1
+                if references[entry['object']]:
+                    continue
+                object_path = self._object_path(entry['object'])
+                try:
+                    size -= object_path.stat().st_size
+                except FileNotFoundError:
+                    continue
+                object_path.unlink(missing_ok=True)
+            self._size = size
+        if evicted:
+            self.logger.info(f'Evicted {evicted} cached responses')
+
+    def entries(self, endpoint=None):
+        """
+        Read every cached response, oldest pull first so newer data wins when replayed
+
+        :param endpoint: Only return responses for this API method (str)
+
+        :return: Generator of (endpoint, args, payload) tuples
+        """
+        keys = sorted((entry for _, entry in self._key_entries()
+                       if endpoint is None or entry['endpoint'] == endpoint),
+                      key=lambda entry: entry['fetched_at'])
+        for entry in keys:
+            try:
+                with gzip.open(self._object_path(entry['object'])) as object_file:
+                    payload = json.load(object_file)
+            except (FileNotFoundError, ValueError, OSError):
+                continue
+            yield entry['endpoint'], entry['args'], payload
+
+
+class CachedGarmin:
+    """
+    Stand in for the Garmin API class that answers reads from a ResponseCache.
+
+    In replay mode nothing is sent to garmin: a cache miss raises a LookupError and
+    writes such as set_activity_type are skipped. In refresh mode every read goes to
+    garmin and the cache is only updated, for days garmin may have synced late.
+    """
+
+    def __init__(self, api, cache, replay=False, refresh=False):
+        """
+        :param api: garmin API Class, can be None in replay mode (Garmin)
+        :param cache: Cache to read and save responses (ResponseCache)
+        :param replay: Only use the cache and never call garmin (bool)
+        :param refresh: Always call garmin and save the new responses (bool)
+        """
+        self.api = api
+        self.cache = cache
+        self.replay = replay
+        self.refresh = refresh
+        self.hits = self.misses = 0
+
+    def _call(self, endpoint, *args):
+        payload = None if self.refresh else self.cache.get(endpoint, *args)
+        if payload is not None:
+            self.hits += 1
+            return payload
+        if self.replay:
+            raise LookupError(f'{endpoint}{args} is not in the cache')
+        self.misses += 1
+        payload = getattr(self.api, endpoint)(*args)
+        self.cache.put(endpoint, args, payload)
+        return payload
+
+    def get_stats(self, cdate):
+        return self._call('get_stats', cdate)
+
+    def get_activities_by_date(self, startdate, enddate):
+        return self._call('get_activities_by_date', startdate, enddate)
+
+    def get_weigh_ins(self, startdate, enddate):
+        return self._call('get_weigh_ins', startdate, enddate)
+
+    def get_heart_rates(self, cdate):
+        return self._call('get_heart_rates', cdate)
+
+    def get_stress_data(self, cdate):
+        return self._call('get_stress_data', cdate)
+
+    def get_steps_data(self, cdate):
+        return self._call('get_steps_data', cdate)
+
+    def set_activity_type(self, *args, **kwargs):
+        if self.replay:
+            return None
+        return self.api.set_activity_type(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
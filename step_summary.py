@@ -0,0 +1,91 @@
+import datetime as dt
+
+from sqlalchemy import Integer, and_, cast, extract, func, select, true
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from model import DEFAULT_ACCOUNT, GarminStat, StepYearSummary
+
+GOAL_MET = and_(GarminStat.total_steps >= GarminStat.step_goal, GarminStat.step_goal != 0)
+
+
+def refresh_step_summary(session, years=None, account=None):
+    """
+    Recompute the step_year_summary rows from daily_stats
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param years: Years to recompute, all of them if not given (iterable of int)
+    :param account: Account to recompute, every account if not given (str)
+    """
+    year = cast(extract('year', GarminStat.date), Integer)
+    # sqlite can't parse INSERT ... SELECT ... ON CONFLICT without a WHERE
+    query = select(
+        GarminStat.account, year, func.count(), func.count().filter(GOAL_MET), func.sum(GarminStat.total_steps),
+        func.min(GarminStat.date), func.max(GarminStat.date)
+    ).where(true()).group_by(GarminStat.account, year)
+    if years is not None:
+        years = sorted(set(years))
+        query = query.where(GarminStat.date.between(dt.date(years[0], 1, 1), dt.date(years[-1], 12, 31)))
+    if account is not None:
+        query = query.where(GarminStat.account == account)
+
+    columns = ['account', 'year', 'days', 'goal_met_days', 'total_steps', 'first_date', 'last_date']
+    insert = sqlite_insert if session.get_bind().dialect.name == 'sqlite' else pg_insert
+    stmt = insert(StepYearSummary).from_select(columns, query)
+    stmt = stmt.on_conflict_do_update(index_elements=['account', 'year'],
+                                      set_={col: stmt.excluded[col] for col in columns[2:]})
+    session.execute(stmt)
+
+
+def step_aggregates(session, start_date=None, end_date=None, account=DEFAULT_ACCOUNT):
+    """
+    Count the days, goal met days and steps in daily_stats for a date range
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param start_date: First day to count, no lower bound if not given (datetime.date)
+    :param end_date: Last day to count, no upper bound if not given (datetime.date)
+    :param account: Account to count (str)
+
+    :return: days, goal_met_days, total_steps (int, int, int)
+    """
+    query = session.query(func.count(), func.count().filter(GOAL_MET),
+                          func.coalesce(func.sum(GarminStat.total_steps), 0))\
+        .filter(GarminStat.account == account)
+    if start_date:
+        query = query.filter(GarminStat.date >= start_date)
+    if end_date:
+        query = query.filter(GarminStat.date <= end_date)
+    days, goal_met_days, total_steps = query.one()
+    return days, goal_met_days, int(total_steps)
+
+
+def get_step_totals(session, end_date=None, account=DEFAULT_ACCOUNT):
+    """
+    Get the step totals for the year to date, the years before it and lifetime. Full years
+    come from step_year_summary so only the days of the current year are read from daily_stats.
+    The summary is rebuilt first if it doesn't go back to the account's first day of stats.
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param end_date: Last day to count, defaults to yesterday (datetime.date)
+    :param account: Account to count (str)
+
+    :return: totals: end_date plus (days, goal_met_days, total_steps) for ytd, prior and lifetime (dict)
+    """
+    end_date = end_date if end_date else dt.date.today() - dt.timedelta(days=1)
+    first_date, last_date = session.query(func.min(GarminStat.date), func.max(GarminStat.date))\
+        .filter(GarminStat.account == account).one()
+    end_date = min(end_date, last_date)
+    # syncs only refresh the years they write, so history from before the summary existed is missing
+    first_year = session.query(func.min(StepYearSummary.year)).filter(StepYearSummary.account == account).scalar()
+    if first_year is None or first_year > first_date.year:
+        refresh_step_summary(session, account=account)
+
+    prior = session.query(
+        func.coalesce(func.sum(StepYearSummary.days), 0),
+        func.coalesce(func.sum(StepYearSummary.goal_met_days), 0),
+        func.coalesce(func.sum(StepYearSummary.total_steps), 0)
+    ).filter(StepYearSummary.account == account, StepYearSummary.year < end_date.year).one()
+    prior = tuple(int(value) for value in prior)
+    ytd = step_aggregates(session, dt.date(end_date.year, 1, 1), end_date, account)
+    return {'end_date': end_date, 'ytd': ytd, 'prior': prior,
+            'lifetime': tuple(ytd_value + prior_value for ytd_value, prior_value in zip(ytd, prior))}
@@ -0,0 +1,132 @@
+import datetime as dt
+
+from model import DEFAULT_ACCOUNT, SyncState
+
+DATA_TYPES = ('daily_stats', 'activities', 'weigh_ins')
+# garmin can still be syncing the days from today back this many days
+OPEN_DAYS = 1
+
+
+def date_chunks(start_date, end_date, chunk_days):
+    """
+    Split a date range into chunks of whole days
+
+    :param start_date: First day of the range (datetime.date)
+    :param end_date: Last day of the range (datetime.date)
+    :param chunk_days: Max days in each chunk (int)
+
+    :return: Generator of (chunk_start, chunk_end) tuples (datetime.date, datetime.date)
+    """
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + dt.timedelta(days=chunk_days - 1), end_date)
+        yield chunk_start, chunk_end
+        chunk_start = chunk_end + dt.timedelta(days=1)
+
+
+def get_sync_states(session, account=DEFAULT_ACCOUNT):
+    """
+    Get an account's sync state for each data type, creating any that are missing
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param account: Account the states are for (str)
+
+    :return: states: Sync state keyed by data type (dict of SyncState)
+    """
+    states = {state.data_type: state for state in session.query(SyncState).filter(SyncState.account == account)}
+    for data_type in DATA_TYPES:
+        if data_type not in states:
+            states[data_type] = SyncState(account=account, data_type=data_type, updated_at=dt.datetime.now())
+            session.add(states[data_type])
+    return states
+
+
+def incremental_start(session, default_start, account=DEFAULT_ACCOUNT):
+    """
+    Get the first day that still needs to be pulled for an incremental sync
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param default_start: Day to start from if a data type has never been synced or hasn't
+        been synced back that far (datetime.date)
+    :param account: Account being synced (str)
+
+    :return: start_date: Day after the oldest completed day across the data types (datetime.date)
+    """
+    states = get_sync_states(session, account).values()
+    completed = [state.last_completed_date for state in states]
+    if None in completed:
+        return default_start
+    # a backfill from before the synced days has to start at the beginning
+    if any(state.first_completed_date and default_start < state.first_completed_date for state in states):
+        return default_start
+    return min(completed) + dt.timedelta(days=1)
+
+
+def resume_start(session, start_date, end_date, account=DEFAULT_ACCOUNT):
+    """
+    Pick up a backfill of the same range where the last run stopped
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param start_date: Start of the requested range (datetime.date)
+    :param end_date: End of the requested range (datetime.date)
+    :param account: Account being synced (str)
+
+    :return: start_date: Day after the last committed chunk, or the requested start (datetime.date)
+    """
+    checkpoints = {(state.checkpoint_start, state.checkpoint_date)
+                   for state in get_sync_states(session, account).values()}
+    if len(checkpoints) != 1:
+        return start_date
+    checkpoint_start, checkpoint_date = checkpoints.pop()
+    if checkpoint_start == start_date and checkpoint_date and start_date <= checkpoint_date < end_date:
+        return checkpoint_date + dt.timedelta(days=1)
+    return start_date
+
+
+def extend_completed(state, start_date, end_date):
+    """
+    Add days that were pulled to a state's completed days, unless there is a gap between them
+
+    :param state: Sync state to update (SyncState)
+    :param start_date: First day that was pulled (datetime.date)
+    :param end_date: Last day that was pulled (datetime.date)
+    """
+    if state.last_completed_date is None:
+        state.first_completed_date, state.last_completed_date = start_date, end_date
+        return
+    one_day = dt.timedelta(days=1)
+    if start_date > state.last_completed_date + one_day:
+        return
+    if state.first_completed_date is not None:
+        if end_date < state.first_completed_date - one_day:
+            return
+        state.first_completed_date = min(state.first_completed_date, start_date)
+    state.last_completed_date = max(state.last_completed_date, end_date)
+
+
+def record_progress(session, range_start, range_end, chunk_start, chunk_end, open_days=OPEN_DAYS,
+                    account=DEFAULT_ACCOUNT):
+    """
+    Save that a chunk of a sync was written. Days from today back open_days days are still
+    changing so they never count as completed.
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param range_start: Start of the whole range being synced (datetime.date)
+    :param range_end: End of the whole range being synced (datetime.date)
+    :param chunk_start: First day of the chunk that was written (datetime.date)
+    :param chunk_end: Last day of the chunk that was written (datetime.date)
+    :param open_days: Number of days before today that are still open (int)
+    :param account: Account being synced (str)
+    """
+    last_closed_day = dt.date.today() - dt.timedelta(days=open_days + 1)
+    # the chunks of a range are written in order, so every day from range_start to here is pulled
+    completed = min(chunk_end, last_closed_day)
+    for state in get_sync_states(session, account).values():
+        if completed >= chunk_start:
+            extend_completed(state, range_start, completed)
+        if chunk_end >= range_end:
+            state.checkpoint_start = state.checkpoint_date = None
+        else:
+            state.checkpoint_start = range_start
+            state.checkpoint_date = chunk_end
+        state.updated_at = dt.datetime.now()
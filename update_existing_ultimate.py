@@ -1,22 +1,48 @@
 #!/usr/bin/env pipenv-shebang
+import argparse
 import os
 
 from dotenv import load_dotenv
 
-from get_stats import update_activities
-from model import init_db, Activity
+from accounts import load_accounts
+from model import DEFAULT_ACCOUNT, init_db
+from reclassify import reclassify_db
+
+
+def add_arguments(arg_parser):
+    arg_parser.add_argument('-w', '--workers', default=4, type=int,
+                            help='Number of garmin updates to run at the same time (default 4)')
+    arg_parser.add_argument('--db_only', action='store_true', help='Only update the database, not garmin')
+    arg_parser.add_argument('-a', '--account', default=DEFAULT_ACCOUNT, help='Account to reclassify')
+    arg_parser.add_argument('-c', '--config', default=os.getenv('GARMIN_ACCOUNTS_FILE', '~/.garmin_accounts.json'),
+                            help='Accounts config with the tokenstore of a non default account '
+                                 '(default GARMIN_ACCOUNTS_FILE or ~/.garmin_accounts.json)')
 
-if __name__ == '__main__':
-    load_dotenv()
 
-    db = init_db(os.getenv('GARMIN_DATABASE_PATH'))
-    ultimate_acts = db.query(Activity).filter_by(activity_type_type_id='11').all()
-    update_activities(ultimate_acts, 213, True)
-    for ulti_act in ultimate_acts:
-        ulti_act.activity_type_type_id = 213
-        ulti_act.activity_type_type_key = 'ultimate_disc'
-        ulti_act.activity_type_parent_type_id = 206
-        db.add(ulti_act)
+def main(args):
+    api = None
+    if not args.db_only:
+        # get_stats pulls in the whole sync so only import it when garmin is updated too
+        from get_stats import login_garmin
+        if args.account == DEFAULT_ACCOUNT:
+            api = login_garmin()
+        else:
+            account = next((account for account in load_accounts(args.config) if account['name'] == args.account),
+                           None)
+            if account is None:
+                raise ValueError(f'Account {args.account} is not in {args.config}')
+            password = os.getenv(account['password_env']) if account['password_env'] else None
+            api = login_garmin(account['tokenstore'], account['email'], password)
+    db = init_db()
+    reclassify_db(db, api=api, workers=args.workers, account=args.account)
     db.commit()
     db.close()
     print('done')
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    main_parser = argparse.ArgumentParser(prog='update_existing_ultimate',
+                                          description='Apply the activity type rules to activities already saved')
+    add_arguments(main_parser)
+    main(main_parser.parse_args())
@@ -0,0 +1,161 @@
+import datetime as dt
+import queue
+import threading
+
+import razator_utils
+from sqlalchemy import literal_column, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from metrics import RUN_METRICS
+from model import DEFAULT_ACCOUNT
+
+
+def chunked(rows, chunk_size):
+    """
+    Split a list of rows into chunks
+
+    :param rows: Rows to split up (list)
+    :param chunk_size: Max rows in each chunk (int)
+
+    :return: Generator of lists with at most chunk_size rows
+    """
+    for i in range(0, len(rows), chunk_size):
+        yield rows[i:i + chunk_size]
+
+
+# sqlite only allows this many bound parameters in one statement
+SQLITE_MAX_PARAMETERS = 32766
+
+
+def existing_keys(session, table, primary_key, rows):
+    """
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param table: Table to look in (sqlalchemy.Table)
+    :param primary_key: Primary key column names (list of str)
+    :param rows: Rows to look for (list of dicts)
+
+    :return: keys: Primary keys of the rows that are already in the table (set of tuples)
+    """
+    key_columns = [table.c[col] for col in primary_key]
+    keys = [tuple(row[col] for col in primary_key) for row in rows]
+    if len(key_columns) == 1:
+        where = key_columns[0].in_([key[0] for key in keys])
+    else:
+        where = tuple_(*key_columns).in_(keys)
+    return set(tuple(row) for row in session.execute(select(*key_columns).where(where)))
+
+
+def upsert_rows(session, model, rows, chunk_size=1000):
+    """
+    Insert rows into a models table with INSERT ... ON CONFLICT DO UPDATE, one statement per chunk.
+    Works on postgres and sqlite, both support the same upsert syntax.
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param model: Model class for the table (GarminStat, Activity, WeighIn, ...)
+    :param rows: Rows to write, keys are the column names (list of dicts)
+    :param chunk_size: Max rows to send in each statement (int)
+
+    :return: inserted, updated: Count of new rows and rows that already existed (int, int)
+    """
+    table = model.__table__
+    columns = table.columns.keys()
+    primary_key = [col.name for col in table.primary_key.columns]
+
+    is_sqlite = session.get_bind().dialect.name == 'sqlite'
+    if is_sqlite:
+        chunk_size = max(min(chunk_size, SQLITE_MAX_PARAMETERS // len(columns)), 1)
+
+    if 'updated_at' in columns:
+        # stamp every write so the parquet export can tell which partitions changed
+        now = dt.datetime.now()
+        rows = [{**row, 'updated_at': now} for row in rows]
+
+    # postgres refuses to update the same row twice in one statement so the last row for a key wins
+    unique_rows = {tuple(row[col] for col in primary_key): row for row in rows}
+
+    inserted = updated = 0
+    for chunk in chunked(list(unique_rows.values()), chunk_size):
+        chunk_columns = [col for col in columns if any(col in row for row in chunk)]
+        insert = sqlite_insert if is_sqlite else pg_insert
+        stmt = insert(table).values([{col: row.get(col) for col in chunk_columns} for row in chunk])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=primary_key,
+            set_={col: stmt.excluded[col] for col in chunk_columns if col not in primary_key}
+        )
+        with RUN_METRICS.timer('db_write', table=table.name):
+            if is_sqlite:
+                chunk_updated = len(existing_keys(session, table, primary_key, chunk))
+                session.execute(stmt)
+            else:
+                # xmax is only 0 for rows that were just inserted
+                results = session.execute(stmt.returning(literal_column('xmax = 0'))).scalars().all()
+                chunk_updated = sum(1 for was_inserted in results if not was_inserted)
+        chunk_inserted = len(chunk) - chunk_updated
+        inserted += chunk_inserted
+        updated += chunk_updated
+        RUN_METRICS.increment('rows_written', chunk_inserted, table=table.name, action='inserted')
+        RUN_METRICS.increment('rows_written', chunk_updated, table=table.name, action='updated')
+
+    return inserted, updated
+
+
+def write_stream(session, rows, chunk_size=1000, logger=razator_utils.log.get_stout_logger('garmin_upsert'),
+                 max_queued_chunks=4, account=DEFAULT_ACCOUNT):
+    """
+    Upsert a stream of rows in chunks. The writes run on a background thread so the
+    database works on one chunk while the next rows are being pulled, and only
+    max_queued_chunks chunks are ever held in memory.
+
+    :param session: Database session, only used by the writer thread until this returns (sqlalchemy.orm.Session)
+    :param rows: Rows tagged with the model they belong to (iterable of (type, dict) tuples)
+    :param chunk_size: Max rows to send in each statement (int)
+    :param logger: Logger object (logging.Logger)
+    :param max_queued_chunks: Chunks that can wait for the writer before pulling more rows blocks (int)
+    :param account: Account the rows belong to, set on the rows of tables with an account column (str)
+
+    :return: counts: Inserted and updated counts keyed by table name (dict of (int, int))
+    """
+    chunks = queue.Queue(maxsize=max_queued_chunks)
+    counts = {}
+    errors = []
+
+    def writer():
+        while (item := chunks.get()) is not None:
+            if errors:
+                continue
+            model, chunk = item
+            try:
+                inserted, updated = upsert_rows(session, model, chunk, chunk_size)
+            except Exception as e:
+                errors.append(e)
+                continue
+            table_inserted, table_updated = counts.get(model.__tablename__, (0, 0))
+            counts[model.__tablename__] = (table_inserted + inserted, table_updated + updated)
+
+    writer_thread = threading.Thread(target=writer, name='garmin_writer', daemon=True)
+    writer_thread.start()
+    buffers = {}
+    try:
+        for model, row in rows:
+            if errors:
+                break
+            if 'account' in model.__table__.c:
+                row['account'] = account
+            buffer = buffers.setdefault(model, [])
+            buffer.append(row)
+            if len(buffer) >= chunk_size:
+                chunks.put((model, buffer))
+                buffers[model] = []
+        for model, buffer in buffers.items():
+            if buffer:
+                chunks.put((model, buffer))
+    finally:
+        chunks.put(None)
+        writer_thread.join()
+    if errors:
+        raise errors[0]
+
+    for table_name, (inserted, updated) in counts.items():
+        logger.info(f'{table_name}: {inserted} inserted, {updated} updated')
+    return counts
@@ -1,78 +1,137 @@
+#!/usr/bin/env pipenv-shebang
+import argparse
 import datetime as dt
-import os
 from pathlib import Path
 
-import pygsheets
 from dotenv import load_dotenv
-from sqlalchemy import func
+from sqlalchemy import case, func
 
-from model import Activity, WeighIn, init_db
+from analytics import daily_weights, load_arrays, weight_trend
+from model import DEFAULT_ACCOUNT, Activity, init_db
 
+RUN_TYPE_IDS = [1, 18]
+ULTIMATE_TYPE_IDS = [213]
+METERS_TO_MILES = 0.000621371
+WEIGHT_START_ROW = 65
 
-def average(num_list):
-    return sum(num_list) / len(num_list)
 
+def as_date(value):
+    # func.date comes back as a string from some databases
+    return value if isinstance(value, dt.date) else dt.date.fromisoformat(value)
 
-def get_activities(types, act_date):
-    return session.query(Activity)\
-        .filter(func.date(Activity.start_time_local) == act_date)\
-        .filter(Activity.activity_type_type_id.in_(types))\
+
+def get_daily_weights(session, start_date, end_date, account=DEFAULT_ACCOUNT):
+    """
+    Get the average weight for each day with a weigh-in, from the cached analytics arrays
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param start_date: First day to get (datetime.date)
+    :param end_date: Last day to get (datetime.date)
+    :param account: Account to get (str)
+
+    :return: Average weight in lbs keyed by date (dict)
+    """
+    return daily_weights(load_arrays(session, account), start_date, end_date)
+
+
+def get_daily_distances(session, start_date, end_date, account=DEFAULT_ACCOUNT):
+    """
+    Get the running and ultimate miles for each day with one of those activities
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param start_date: First day to get (datetime.date)
+    :param end_date: Last day to get (datetime.date)
+    :param account: Account to get (str)
+
+    :return: (running miles, ultimate miles) keyed by date, None if there were none that day (dict)
+    """
+    act_date = func.date(Activity.start_time_local)
+    rows = session.query(
+        act_date,
+        func.sum(case((Activity.activity_type_type_id.in_(RUN_TYPE_IDS), Activity.distance))),
+        func.sum(case((Activity.activity_type_type_id.in_(ULTIMATE_TYPE_IDS), Activity.distance)))
+    )\
+        .filter(Activity.account == account)\
+        .filter(Activity.activity_type_type_id.in_(RUN_TYPE_IDS + ULTIMATE_TYPE_IDS))\
+        .filter(act_date.between(start_date, end_date))\
+        .group_by(act_date)\
         .all()
+    return {as_date(row_date): tuple(round(distance * METERS_TO_MILES, 2) if distance else None
+                                     for distance in (run_distance, ulti_distance))
+            for row_date, run_distance, ulti_distance in rows}
+
+
+def cell_changed(cell, value):
+    """
+    :param cell: Cell in the sheet (pygsheets.Cell)
+    :param value: Value that should be in the cell, None for blank (float)
+
+    :return: If the cell needs to be written (bool)
+    """
+    if value is None:
+        return cell.value != ''
+    try:
+        return float(cell.value.replace(',', '')) != value
+    except ValueError:
+        return True
+
+
+def get_sheet_updates(session, rows, account=DEFAULT_ACCOUNT):
+    """
+    Work out which cells need new values. Every row gets its running (D) and ultimate (E)
+    miles, rows from WEIGHT_START_ROW on without a weight (B) get the average weigh-in.
+
+    :param session: Database session (sqlalchemy.orm.Session)
+    :param rows: Rows of cells from column A to E (list of lists of pygsheets.Cell)
+    :param account: Account whose weigh-ins and activities go on the sheet (str)
+
+    :return: updates: Cell labels and the value to write to each (list of (str, float or str))
+    """
+    row_dates = [dt.datetime.strptime(row[0].value, '%m/%d/%Y').date() for row in rows]
+    start_date, end_date = min(row_dates), max(row_dates)
+    weights = get_daily_weights(session, start_date, end_date, account)
+    distances = get_daily_distances(session, start_date, end_date, account)
+
+    updates = []
+    for row, row_date in zip(rows, row_dates):
+        if row[0].row >= WEIGHT_START_ROW and not row[1].value and (weight := weights.get(row_date)):
+            updates.append((row[1].label, weight))
+        for cell, distance in zip(row[3:5], distances.get(row_date, (None, None))):
+            if cell_changed(cell, distance):
+                updates.append((cell.label, '' if distance is None else distance))
+    return updates
+
+
+def add_arguments(arg_parser):
+    arg_parser.add_argument('-c', '--cred_file', default=Path.home() / '.creds' / 'gdrive.json',
+                            type=lambda value: Path(value).expanduser(),
+                            help='Google service account json (default ~/.creds/gdrive.json)')
+    arg_parser.add_argument('-a', '--account', default=DEFAULT_ACCOUNT, help='Account to fill the sheet from')
+
+
+def main(args):
+    # pygsheets is slow to import so only load it once the sheet is actually opened
+    import pygsheets
+
+    gc = pygsheets.authorize(service_file=args.cred_file)
+    weight_sheet = gc.open('Daily Weigh-In').worksheet_by_title('daily_data')
+    session = init_db()
+
+    cells = weight_sheet.range(f'A2:E{weight_sheet.rows - 1}')
+    updates = get_sheet_updates(session, cells, args.account)
+    trend_days, trend = weight_trend(load_arrays(session, args.account))
+    session.close()
+    if len(trend):
+        print(f'Weight trend {trend[-1]:.1f} lbs on {trend_days[-1]}')
+    print(f'Updating {len(updates)} cells...')
+    if updates:
+        weight_sheet.update_values_batch([label for label, _ in updates], [[[value]] for _, value in updates])
+    print('done')
 
 
-load_dotenv()
-cred_file = Path.home() / '.creds' / 'gdrive.json'
-gc = pygsheets.authorize(service_file=cred_file)
-weight_sheet = gc.open('Daily Weigh-In').worksheet_by_title('daily_data')
-session = init_db()
-
-# put in weights
-cells = weight_sheet.range(f'A65:E{weight_sheet.rows - 1}')
-for row in cells:
-    if row[1].value:
-        continue
-    row_date = dt.datetime.strptime(row[0].value, '%m/%d/%Y').date()
-    print(f'Updating {row_date}...')
-    run_acts = get_activities([1, 18], row_date)
-    if run_acts:
-        distance = round(sum(act.distance_miles for act in run_acts if act.distance_miles), 2)
-        if distance:
-            row[3].set_value(distance)
-    ulti_acts = get_activities([213], row_date)
-    if ulti_acts:
-        distance = round(sum(act.distance_miles for act in ulti_acts if act.distance_miles), 2)
-        if distance:
-            row[4].set_value(distance)
-    weights = session.query(WeighIn).filter_by(calendar_date=row_date).all()
-    if weights:
-        weight = round(average([w.weight_lbs for w in weights]), 1)
-        row[1].set_value(weight)
-session.close()
-print('done')
-
-start_date = dt.date(2024, 9, 12)
-today = dt.date.today()
-cells = weight_sheet.range(f'A2:A{weight_sheet.rows - 1}')
-running_by_day = session.query(
-    func.date(Activity.start_time_local),
-    func.sum(Activity.distance)
-)\
-    .filter(Activity.activity_type_type_id.in_([1, 18]))\
-    .filter(Activity.start_time_local >= '2017-01-13')\
-    .group_by(func.date(Activity.start_time_local))\
-    .all()
-ulti_by_day = session.query(
-    func.date(Activity.start_time_local),
-    func.sum(Activity.distance)
-)\
-    .filter_by(activity_type_type_id=213)\
-    .filter(Activity.start_time_local >= '2017-01-13')\
-    .group_by(func.date(Activity.start_time_local))\
-    .all()
-running_by_day = {dt.date.fromisoformat(r[0]): round(r[1] * 0.000621371, 2) for r in running_by_day}
-ulti_by_day = {dt.date.fromisoformat(r[0]): round(r[1] * 0.000621371, 2) for r in ulti_by_day}
-distance_values = []
-for row in cells:
-    row_date = dt.datetime.strptime(row[0].value, '%m/%d/%Y').date()
-    distance_values.append([running_by_day.get(row_date), ulti_by_day.get(row_date)])
-weight_sheet.update_values(f'D2:E{weight_sheet.rows - 1}', distance_values)
+if __name__ == '__main__':
+    load_dotenv()
+    main_parser = argparse.ArgumentParser(prog='weights_to_gsheet',
+                                          description='Fill in the weights and distances on the weigh-in sheet')
+    add_arguments(main_parser)
+    main(main_parser.parse_args())